@@ -0,0 +1,43 @@
+import configparser
+
+from time import time
+
+import dbmanager
+
+
+# Writer that records when each batch would have been committed instead of talking to Postgres
+class FakePresenceWriter(dbmanager.PresenceWriter):
+
+    def _write(self, batch, events=()):
+        committed = time()
+        self.dbmanager.committed.extend((extension, presence, committed) for extension, (presence, received) in batch.items())
+        self.dbmanager.batches.append(len(batch))
+        return True
+
+
+# In-memory stand-in for DatabaseManager, the extensions come from a list and presence goes through the real writer stage
+class FakeDatabaseManager(dbmanager.DatabaseManager):
+    extensions = []
+
+    def __init__(self, SubscriptionApp):
+        self.subscriptionapp = SubscriptionApp
+        config = configparser.ConfigParser()
+        config.read('config.ini')
+        # Uses the same batching settings as the real database would
+        self.flushinterval = config.getint('DATABASECONFIG', 'flush_interval', fallback=250) / 1000.0
+        self.flushthreshold = config.getint('DATABASECONFIG', 'flush_threshold', fallback=500)
+        self.eventlogtable = ''
+        self.listener = None
+        self.committed = [] # (extension, presence, time committed) of every written status
+        self.batches = []
+        self.writer = FakePresenceWriter(self)
+        self.writer.start()
+
+    def loadExtensions(self):
+        self.subscriptionapp._reconcile_extensions(list(self.extensions))
+
+    def startListening(self):
+        pass
+
+    def destroyDBConnection(self):
+        self.writer.stop()
@@ -0,0 +1,261 @@
+import json
+import random
+import socket
+import sys
+import threading
+import uuid
+
+from optparse import OptionParser
+from time import sleep, time
+
+# Status notes in the same form FreeSWITCH puts them in, see presencecodes.txt
+PIDF_TEMPLATE = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<presence xmlns='urn:ietf:params:xml:ns:pidf' xmlns:dm='urn:ietf:params:xml:ns:pidf:data-model' xmlns:rpid='urn:ietf:params:xml:ns:pidf:rpid' xmlns:c='urn:ietf:params:xml:ns:pidf:cipid' entity='sip:%(extension)s@%(host)s'>
+  <tuple id='t%(tupleid)s'>
+    <status>
+      <basic>%(basic)s</basic>
+    </status>
+  </tuple>
+  <dm:person id='p%(tupleid)s'>
+    <rpid:activities><rpid:%(activity)s/></rpid:activities>
+    <dm:note>%(note)s</dm:note>
+  </dm:person>
+</presence>"""
+
+ACTIVITIES = {'available': 'unknown', 'talk': 'on-the-phone', 'call': 'on-the-phone', 'ring': 'on-the-phone', 'unregistered': 'unknown'}
+
+# Compact header names a SIP stack may use
+COMPACT_HEADERS = {'f': 'from', 't': 'to', 'i': 'call-id', 'v': 'via', 'm': 'contact', 'l': 'content-length', 'c': 'content-type', 'o': 'event'}
+
+
+class Dialog(object):
+
+    def __init__(self, extension, callid, fromheader, toheader, target, address, expires):
+        self.extension = extension
+        self.callid = callid
+        self.fromheader = fromheader # The subscriber's From, used as the To of NOTIFYs
+        self.toheader = toheader # Our side of the dialog, tag included
+        self.target = target
+        self.address = address
+        self.expires = expires
+        self.cseq = 0
+        self.status = 'available'
+        self.tupleid = uuid.uuid4().hex[:8] # Stays the same for the dialog, so repeats of a status are byte for byte identical like a real server's
+
+
+# Stand-in for a SIP presence server, accepts every SUBSCRIBE and generates NOTIFY traffic for the dialogs
+class FakePresenceServer(object):
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.socket.bind((host, port))
+        self.dialogs = {} # Extension to its dialog
+        self.lock = threading.Lock()
+        self.sent = [] # (extension, status, time sent) of every NOTIFY that changed a status
+        self.notifies = 0
+        self.answered = 0 # NOTIFYs the subscriber answered with a 200
+        self.messages = 0
+        self.running = True
+
+    def serve(self):
+        while self.running:
+            try:
+                data, address = self.socket.recvfrom(65535)
+            except socket.error:
+                break
+            try:
+                self._handle(data, address)
+            except (KeyError, ValueError, IndexError):
+                pass
+
+    def stop(self):
+        self.running = False
+        self.socket.close()
+
+    def notify(self, extension, status, record=True):
+        # Sends the status in a NOTIFY on the extension's dialog
+        with self.lock:
+            dialog = self.dialogs.get(extension)
+            if dialog is None:
+                return
+            dialog.status = status
+            dialog.cseq += 1
+            cseq = dialog.cseq
+            tupleid = dialog.tupleid
+        code = status.split(' ')[0]
+        body = PIDF_TEMPLATE % {'extension': extension, 'host': self.host, 'tupleid': tupleid,
+                                'basic': 'closed' if code == 'unregistered' else 'open', 'activity': ACTIVITIES[code], 'note': status.capitalize()}
+        request = ['NOTIFY %s SIP/2.0' % dialog.target,
+                   'Via: SIP/2.0/UDP %s:%d;rport;branch=z9hG4bK%s' % (self.host, self.port, uuid.uuid4().hex),
+                   'Max-Forwards: 70',
+                   'From: %s' % dialog.toheader,
+                   'To: %s' % dialog.fromheader,
+                   'Call-ID: %s' % dialog.callid,
+                   'CSeq: %d NOTIFY' % cseq,
+                   'Contact: <sip:presence@%s:%d>' % (self.host, self.port),
+                   'Event: presence',
+                   'Subscription-State: active;expires=%d' % dialog.expires,
+                   'Content-Type: application/pidf+xml',
+                   'Content-Length: %d' % len(body)]
+        if record:
+            self.sent.append((extension, status.lower(), time()))
+        self.notifies += 1
+        self.socket.sendto('\r\n'.join(request) + '\r\n\r\n' + body, dialog.address)
+
+    def _handle(self, data, address):
+        head, _, body = data.partition('\r\n\r\n')
+        lines = head.split('\r\n')
+        first = lines[0]
+        headers = {}
+        vias = []
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            name = COMPACT_HEADERS.get(name, name)
+            if name == 'via':
+                vias.append(value.strip())
+            else:
+                headers[name] = value.strip()
+        if first.startswith('SIP/2.0'):
+            # A response, the only requests we send are NOTIFYs
+            if first.split(' ')[1] == '200':
+                self.answered += 1
+            return
+        method = first.split(' ')[0]
+        if method == 'SUBSCRIBE':
+            self._subscribe(headers, vias, address)
+        elif method in ('MESSAGE', 'OPTIONS'):
+            if method == 'MESSAGE':
+                self.messages += 1
+            self._respond(headers, vias, address, headers['to'])
+
+    def _subscribe(self, headers, vias, address):
+        expires = int(headers.get('expires', '600'))
+        extension = headers['to'].split('sip:', 1)[1].split('@', 1)[0]
+        toheader = headers['to']
+        if ';tag=' not in toheader:
+            toheader = '%s;tag=%s' % (toheader, uuid.uuid4().hex[:10])
+        self._respond(headers, vias, address, toheader, ['Expires: %d' % expires])
+        target = headers['contact'].split('<', 1)[-1].split('>', 1)[0]
+        with self.lock:
+            dialog = self.dialogs.get(extension)
+            if expires == 0:
+                self.dialogs.pop(extension, None)
+                return
+            if dialog is None or dialog.callid != headers['call-id']:
+                dialog = Dialog(extension, headers['call-id'], headers['from'], toheader, target, address, expires)
+                self.dialogs[extension] = dialog
+            dialog.expires = expires
+        # Both new subscriptions and refreshes get the current state, like a real server
+        self.notify(extension, dialog.status, record=False)
+
+    def _respond(self, headers, vias, address, toheader, extra=()):
+        response = ['SIP/2.0 200 OK']
+        response.extend('Via: %s' % via for via in vias)
+        response.extend(['From: %s' % headers['from'],
+                         'To: %s' % toheader,
+                         'Call-ID: %s' % headers['call-id'],
+                         'CSeq: %s' % headers['cseq'],
+                         'Contact: <sip:presence@%s:%d>' % (self.host, self.port)])
+        response.extend(extra)
+        response.append('Content-Length: 0')
+        self.socket.sendto('\r\n'.join(response) + '\r\n\r\n', address)
+
+
+def random_status(extensions):
+    code = random.choice(('available', 'talk', 'call', 'ring', 'unregistered'))
+    if code in ('available', 'unregistered'):
+        return code
+    return '%s %s' % (code, random.choice(extensions))
+
+
+def run_steady(server, extensions, rate, duration):
+    # Random extensions change status at a constant total rate
+    end = time() + duration
+    interval = 1.0 / rate
+    nextsend = time()
+    while time() < end:
+        extension = random.choice(extensions)
+        status = random_status(extensions)
+        if status != server.dialogs[extension].status:
+            server.notify(extension, status)
+        nextsend += interval
+        delay = nextsend - time()
+        if delay > 0:
+            sleep(delay)
+
+
+def run_burst(server, extensions, rate, duration):
+    # Shift changes, every extension changes within a couple of seconds and then things go quiet
+    end = time() + duration
+    while time() < end:
+        burststart = time()
+        for extension in extensions:
+            status = 'available' if server.dialogs[extension].status != 'available' else 'unregistered'
+            server.notify(extension, status)
+        sleep(max(duration / 3.0 - (time() - burststart), 0))
+
+
+def run_refresh(server, extensions, rate, duration):
+    # Only repeats of the current state, the subscriber should not write anything
+    end = time() + duration
+    interval = 1.0 / rate
+    nextsend = time()
+    while time() < end:
+        extension = random.choice(extensions)
+        server.notify(extension, server.dialogs[extension].status, record=False)
+        nextsend += interval
+        delay = nextsend - time()
+        if delay > 0:
+            sleep(delay)
+
+
+SCENARIOS = {'steady': run_steady, 'burst': run_burst, 'refresh': run_refresh}
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=5062)
+    parser.add_option('--extensions', type='int', default=100, help='number of subscriptions to wait for')
+    parser.add_option('--scenario', default='steady', help='steady, burst or refresh')
+    parser.add_option('--rate', type='float', default=200, help='NOTIFYs per second for the steady and refresh scenarios')
+    parser.add_option('--duration', type='float', default=30, help='seconds the scenario runs for')
+    parser.add_option('--wait', type='float', default=300, help='seconds to wait for every extension to subscribe')
+    parser.add_option('--log', default=None, help='file the NOTIFYs that changed a status are written to')
+    options, args = parser.parse_args()
+
+    server = FakePresenceServer(options.host, options.port)
+    receiver = threading.Thread(target=server.serve)
+    receiver.daemon = True
+    receiver.start()
+    print("listening %s:%d" % (options.host, options.port))
+    sys.stdout.flush()
+
+    # Waits for the subscriber to subscribe to everyone
+    deadline = time() + options.wait
+    while len(server.dialogs) < options.extensions and time() < deadline:
+        sleep(0.1)
+    extensions = sorted(server.dialogs)
+    if not extensions:
+        print("failed no subscriptions")
+        sys.exit(1)
+
+    answered = server.answered
+    notifies = server.notifies
+    started = time()
+    print("started %s" % json.dumps({"subscribed": len(extensions)}))
+    sys.stdout.flush()
+    SCENARIOS[options.scenario](server, extensions, options.rate, options.duration)
+    # Gives the subscriber a moment to answer the last NOTIFYs
+    sleep(1)
+    elapsed = time() - started
+    if options.log:
+        with open(options.log, 'w') as logfile:
+            json.dump(server.sent, logfile)
+    print("finished %s" % json.dumps({"subscribed": len(extensions), "notifies": server.notifies - notifies, "answered": server.answered - answered, "changes": len(server.sent), "messages": server.messages, "elapsed": elapsed}))
+    sys.stdout.flush()
+    server.stop()
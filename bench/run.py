@@ -0,0 +1,140 @@
+import bisect
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+
+from optparse import OptionParser
+from time import time
+
+# Runs from the repository root so config.ini and the application modules are found
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from twisted.internet import reactor
+
+from sipsimple.core import Route
+from sipsimple.threading import run_in_twisted_thread
+
+import main
+
+from fakedb import FakeDatabaseManager
+
+
+# The real application, pointed at the fake presence server and the in-memory database
+class BenchApplication(main.SubscriptionApplication):
+    databasemanager = FakeDatabaseManager
+
+    def __init__(self, options):
+        main.SubscriptionApplication.__init__(self, sipport=options.sipport)
+        if options.account:
+            self.account_name = options.account
+        # No console, the benchmark stops the application itself
+        self.input = None
+        self.serverroute = Route(options.host, options.port, 'udp')
+        self.scheduler.rate = self.scheduler.burst = self.scheduler.tokens = options.subscriberate
+        self.scheduler.maxinflight = options.maxinflight
+
+    @run_in_twisted_thread
+    def _lookup_routes(self):
+        # Every request goes straight to the fake presence server
+        self.routecache.update([self.serverroute])
+        self._dispatch_subscription_queue()
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def notify_to_commit_latencies(sent, committed):
+    # Matches every written status to the latest NOTIFY that carried it before the commit
+    senttimes = {}
+    for extension, status, senttime in sent:
+        senttimes.setdefault((extension, status), []).append(senttime)
+    latencies = []
+    for extension, status, committedtime in committed:
+        times = senttimes.get((extension, status))
+        if not times:
+            continue
+        index = bisect.bisect_right(times, committedtime)
+        if index:
+            latencies.append(committedtime - times[index - 1])
+    latencies.sort()
+    return latencies
+
+
+def watch_server(server, application, options, results):
+    # Follows the fake server's progress and stops the application once the scenario is over
+    for line in iter(server.stdout.readline, ''):
+        if line.startswith('started'):
+            results['started'] = (time(), cpu_seconds())
+        elif line.startswith('finished'):
+            results['finished'] = (time(), cpu_seconds())
+            results['server'] = json.loads(line.split(' ', 1)[1])
+            break
+        elif line.startswith('failed'):
+            break
+    reactor.callFromThread(reactor.callLater, options.drain, application.stop)
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option('--extensions', type='int', default=100)
+    parser.add_option('--scenario', default='steady', help='steady, burst or refresh')
+    parser.add_option('--rate', type='float', default=200, help='NOTIFYs per second for the steady and refresh scenarios')
+    parser.add_option('--duration', type='float', default=30)
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=5062, help='port of the fake presence server')
+    parser.add_option('--sip-port', type='int', dest='sipport', default=5080, help='local SIP port of the application')
+    parser.add_option('--account', default=None, help='sipclient account to use instead of account_name from config.ini')
+    parser.add_option('--subscribe-rate', type='float', dest='subscriberate', default=1000)
+    parser.add_option('--max-inflight', type='int', dest='maxinflight', default=500)
+    parser.add_option('--drain', type='float', default=2, help='seconds to let the writer catch up after the scenario')
+    options, args = parser.parse_args()
+
+    FakeDatabaseManager.extensions = [str(10000 + number) for number in range(options.extensions)]
+    logfile = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    logfile.close()
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakepresence.py'),
+                               '--host', options.host, '--port', str(options.port), '--extensions', str(options.extensions),
+                               '--scenario', options.scenario, '--rate', str(options.rate), '--duration', str(options.duration),
+                               '--log', logfile.name], stdout=subprocess.PIPE)
+
+    application = BenchApplication(options)
+    results = {}
+    watcher = threading.Thread(target=watch_server, args=(server, application, options, results))
+    watcher.daemon = True
+    watcher.start()
+    application.run()
+    server.wait()
+
+    if 'finished' not in results:
+        print(json.dumps({"extensions": options.extensions, "scenario": options.scenario, "error": "the scenario did not finish"}))
+        sys.exit(1)
+    with open(logfile.name) as sentlog:
+        sent = json.load(sentlog)
+    os.unlink(logfile.name)
+    latencies = notify_to_commit_latencies(sent, application.db.committed)
+    startedtime, startedcpu = results['started']
+    finishedtime, finishedcpu = results['finished']
+    elapsed = finishedtime - startedtime
+    print(json.dumps({"extensions": options.extensions,
+                      "scenario": options.scenario,
+                      "notifies": results['server']['notifies'],
+                      "notifies_per_second": results['server']['answered'] / elapsed,
+                      "changes": results['server']['changes'],
+                      "written": len(latencies),
+                      "batches": len(application.db.batches),
+                      "messages": results['server']['messages'],
+                      "latency_ms": dict((name, None if value is None else value * 1000) for name, value in (("p50", percentile(latencies, 0.5)), ("p90", percentile(latencies, 0.9)), ("p99", percentile(latencies, 0.99)), ("max", latencies[-1] if latencies else None))),
+                      "cpu_percent": (finishedcpu - startedcpu) / elapsed * 100,
+                      "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}))
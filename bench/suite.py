@@ -0,0 +1,57 @@
+import json
+import os
+import subprocess
+import sys
+
+from optparse import OptionParser
+
+SIZES = (100, 1000, 10000)
+SCENARIOS = ('steady', 'burst', 'refresh')
+
+
+def run(size, scenario, options):
+    # Each run gets its own process, the SIP engine can only be started once per process
+    arguments = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py'),
+                 '--extensions', str(size), '--scenario', scenario, '--rate', str(options.rate), '--duration', str(options.duration)]
+    if options.account:
+        arguments.extend(['--account', options.account])
+    with open(os.devnull) as devnull:
+        process = subprocess.Popen(arguments, stdin=devnull, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+    lines = [line for line in output.splitlines() if line.startswith('{')]
+    if not lines:
+        return {"extensions": size, "scenario": scenario, "error": "no result, exit code %d" % process.returncode}
+    return json.loads(lines[-1])
+
+
+def format_row(result):
+    if 'error' in result:
+        return '%8d  %-8s  %s' % (result['extensions'], result['scenario'], result['error'])
+    latency = result['latency_ms']
+    milliseconds = lambda value: '-' if value is None else '%.1f' % value
+    return '%8d  %-8s  %10.1f  %8d  %8s  %8s  %8s  %8s  %6.1f  %8.1f' % (result['extensions'], result['scenario'], result['notifies_per_second'], result['written'],
+                                                                          milliseconds(latency['p50']), milliseconds(latency['p90']), milliseconds(latency['p99']), milliseconds(latency['max']),
+                                                                          result['cpu_percent'], result['max_rss_mb'])
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option('--sizes', default=','.join(str(size) for size in SIZES), help='comma separated extension counts')
+    parser.add_option('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios')
+    parser.add_option('--rate', type='float', default=200)
+    parser.add_option('--duration', type='float', default=30)
+    parser.add_option('--account', default=None)
+    parser.add_option('--output', default=None, help='file the raw results are written to as JSON')
+    options, args = parser.parse_args()
+
+    print('%8s  %-8s  %10s  %8s  %8s  %8s  %8s  %8s  %6s  %8s' % ('exts', 'scenario', 'notify/s', 'written', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'cpu %', 'rss MB'))
+    results = []
+    for size in [int(size) for size in options.sizes.split(',')]:
+        for scenario in options.scenarios.split(','):
+            result = run(size, scenario, options)
+            results.append(result)
+            print(format_row(result))
+            sys.stdout.flush()
+    if options.output:
+        with open(options.output, 'w') as outputfile:
+            json.dump(results, outputfile, indent=2)
@@ -1,5 +1,39 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.sql
 import configparser
+import select
+
+from cStringIO import StringIO
+from datetime import datetime
+from threading import Condition, Event, Lock, Thread
+from time import time
+
+# The status codes from presencecodes.txt, transitions store their index instead of the text
+EVENTCODES = ('available', 'talk', 'call', 'ring', 'unregistered')
+EVENTCODEINDEX = dict((code, index) for index, code in enumerate(EVENTCODES))
+
+
+def status_code(status):
+    # Splits a status into its interned code and the peer, codes that are not in presencecodes.txt are kept as text
+    if status is None:
+        return None, None
+    code, _, peer = status.partition(' ')
+    return EVENTCODEINDEX.get(code, code), peer or None
+
+
+def code_name(code):
+    if isinstance(code, int):
+        return EVENTCODES[code]
+    return code
+
+
+def copy_field(value):
+    # Escapes a value for the text format of COPY
+    if value is None:
+        return '\\N'
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
 
 # Manages the config file and pulls info from a DB for SIP extensions to pull from
 class DatabaseManager:
@@ -23,35 +57,357 @@ class DatabaseManager:
         self.table = config['DATABASECONFIG']['table']
         self.readcolumn = config['DATABASECONFIG']['readcolumn'] # The column that has the SIP extensions
         self.writecolumn = config['DATABASECONFIG']['writecolumn'] # The column that will be written to with the updated presence
+        self.flushinterval = config.getint('DATABASECONFIG', 'flush_interval', fallback=250) / 1000.0 # Milliseconds between presence flushes, 0 writes every update right away
+        self.flushthreshold = config.getint('DATABASECONFIG', 'flush_threshold', fallback=500) # Number of dirty extensions that forces an early flush
+        self.listenchannel = config.get('DATABASECONFIG', 'listen_channel', fallback='') # Postgres NOTIFY channel that signals a change to the extensions
+        self.resyncinterval = config.getint('DATABASECONFIG', 'resync_interval', fallback=900) # Seconds between full extension resyncs
+        self.fetchsize = config.getint('DATABASECONFIG', 'fetch_size', fallback=1000) # Extensions read from the database at a time
+        self.eventlogtable = config.get('DATABASECONFIG', 'eventlog_table', fallback='') # Table every presence transition is appended to, blank disables the event log
+        self.eventlogsize = config.getint('DATABASECONFIG', 'eventlog_queue_size', fallback=100000) # Transitions that can wait on a write before the oldest are dropped
+        # Quotes the names from the config file once, a schema qualified table is split into its parts
+        self.tableidentifier = psycopg2.sql.Identifier(*self.table.split('.'))
+        self.readidentifier = psycopg2.sql.Identifier(self.readcolumn)
+        self.writeidentifier = psycopg2.sql.Identifier(self.writecolumn)
+        self.extensionquery = psycopg2.sql.SQL("SELECT DISTINCT {readcolumn} FROM {table} WHERE {readcolumn} IS NOT NULL").format(table=self.tableidentifier, readcolumn=self.readidentifier)
+        if self.eventlogtable:
+            self.eventlogquery = psycopg2.sql.SQL("COPY {table} (extension, old_status, new_status, peer, changed) FROM STDIN").format(table=psycopg2.sql.Identifier(*self.eventlogtable.split('.')))
+        self.listener = None
+        # Keeps the listener and the input thread from sharing the cursor at the same time
+        self.dblock = Lock()
         # Initiates the database connection
-        self.conn = psycopg2.connect(host = self.host, database = self.database, user = self.user, password = self.password, port = self.port)
+        self.conn = self.connect()
         # Creates a cursor
         self.cur = self.conn.cursor()
-        
+        # Presence is written by its own thread and connection so the SIP side never waits on the database
+        self.writer = PresenceWriter(self)
+        self.writer.start()
+
+    def connect(self):
+        return psycopg2.connect(host = self.host, database = self.database, user = self.user, password = self.password, port = self.port)
+
     def loadExtensions(self):
-        # Executes the query to read all extensions
-        query = "SELECT DISTINCT " + self.readcolumn + " FROM " + self.table + " WHERE " + self.readcolumn + " IS NOT NULL"
-        self.cur.execute(query)
-        # Read the values
-        extensionlist = self.cur.fetchall()
-        formattedextensionlist = []
-        # Convert the values from tuples into their individual values
-        for result in extensionlist:
-            formattedextensionlist.append(str(result[0]))
-        print("Retrieved new Subscribe Extensions from DB: %s" % formattedextensionlist)
-        # Add the subscriptions
-        self.subscriptionapp._setup_new_subscriptions(formattedextensionlist)
-
-    def updatePresence(self, extension, presence):
-        # Executes the query to update the record
-        query = "UPDATE " + self.table + " SET " + self.writecolumn + " = '" + str(presence) + "' WHERE " + self.readcolumn + " = '" + str(extension) + "'"
-        status = self.cur.execute(query)
-        self.conn.commit()
+        with self.dblock:
+            try:
+                extensions = self._streamExtensions()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # The connection dropped, tries once more on a new one
+                self._reconnect()
+                extensions = self._streamExtensions()
+        self.subscriptionapp.output.info('Retrieved %d Subscribe Extensions from DB', len(extensions))
+        # Unsubscribes from the removed extensions now that the whole list is known
+        self.subscriptionapp._reconcile_extensions(extensions)
+
+    def _streamExtensions(self):
+        # Reads the extensions through a server side cursor, each batch is subscribed to as soon as it arrives
+        extensions = []
+        cur = self.conn.cursor(name='presence_extensions')
+        try:
+            cur.execute(self.extensionquery)
+            while True:
+                rows = cur.fetchmany(self.fetchsize)
+                if not rows:
+                    break
+                batch = [str(row[0]) for row in rows]
+                extensions.extend(batch)
+                self.subscriptionapp._reconcile_extensions(batch, complete=False)
+        finally:
+            try:
+                cur.close()
+                self.conn.commit()
+            except psycopg2.Error:
+                pass
+        return extensions
+
+    def presenceStatement(self, cur):
+        # Prepared once per writer connection, the extensions and statuses are passed as two arrays so every batch size shares one plan.
+        # The extensions are cast to the column's own type so an index on the extension column can be used
+        cur.execute("SELECT format_type(atttypid, atttypmod) FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped", (self.tableidentifier.as_string(cur), self.readcolumn))
+        row = cur.fetchone()
+        if row is None:
+            raise psycopg2.ProgrammingError("column %s does not exist in %s" % (self.readcolumn, self.table))
+        return psycopg2.sql.SQL("PREPARE update_presence (text[], text[]) AS UPDATE {table} SET {writecolumn} = presence.status FROM unnest($1, $2) AS presence (extension, status) WHERE {table}.{readcolumn} = CAST(presence.extension AS {columntype})").format(table=self.tableidentifier, readcolumn=self.readidentifier, writecolumn=self.writeidentifier, columntype=psycopg2.sql.SQL(row[0]))
+
+    def startListening(self):
+        # Reloads the extensions whenever the table signals a change, and every resync interval regardless
+        self.listener = ExtensionListener(self)
+        self.listener.start()
+
+    def updatePresence(self, extension, presence, received=None):
+        # Hands the presence to the writer thread, this never blocks on the database
+        self.writer.put(str(extension), str(presence), received)
+
+    def removeExtension(self, extension):
+        self.writer.forget(str(extension))
+
+    def logTransition(self, extension, previous, presence, changed):
+        # Queues a status change for the event log, kept as a tuple of interned codes until it is copied
+        if not self.eventlogtable:
+            return
+        code, peer = status_code(presence)
+        self.writer.log((changed, str(extension), status_code(previous)[0], code, peer))
+
+    def _reconnect(self):
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+        self.conn = self.connect()
+        self.cur = self.conn.cursor()
 
     def destroyDBConnection(self):
+        # Stops reacting to extension changes
+        if self.listener is not None:
+            self.listener.stop()
+        # Writes out anything that is still waiting for a flush
+        self.writer.stop()
         # Close the cursor
         self.cur.close()
         # Closes the connection to the database
         self.conn.close()
 
-        
\ No newline at end of file
+
+# Writes presence to the database in batches from its own thread, reconnecting whenever the connection drops
+class PresenceWriter(Thread):
+
+    def __init__(self, dbmanager):
+        Thread.__init__(self)
+        self.dbmanager = dbmanager
+        self.daemon = True
+        self.condition = Condition()
+        self.pending = {} # Only the newest presence of each extension and when its NOTIFY arrived are kept until the next flush
+        self.latest = {} # Every extension's latest presence, written again in full after a reconnect
+        self.events = [] # Transitions waiting for the event log, as (time, extension, previous code, code, peer)
+        self.droppedevents = 0
+        self.replay = False
+        self.stopped = False
+        self.stopevent = Event()
+        self.conn = None
+        self.backoff = 1
+
+    def put(self, extension, presence, received=None):
+        with self.condition:
+            self.latest[extension] = presence
+            # The first pending update wakes the writer to start the flush interval
+            first = not self.pending
+            # A newer update replaces the waiting one, so the backlog never grows past one entry per extension
+            self.pending[extension] = (presence, received)
+            if first or len(self.pending) >= self.dbmanager.flushthreshold or self.dbmanager.flushinterval <= 0:
+                self.condition.notify()
+
+    def forget(self, extension):
+        # The extension was removed, a replay after a reconnect must not write it again
+        with self.condition:
+            self.latest.pop(extension, None)
+            self.pending.pop(extension, None)
+
+    def log(self, event):
+        # Transitions always come with a presence update, so they are written by the same flush
+        with self.condition:
+            if len(self.events) < self.dbmanager.eventlogsize:
+                self.events.append(event)
+            else:
+                self.droppedevents += 1
+
+    def stop(self):
+        # Flushes whatever is pending and waits a little for it to be written
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.stopevent.set()
+        self.join(10)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.replay and not self.stopped:
+                    self.condition.wait()
+                # Lets updates coalesce for the flush interval, unless enough extensions are dirty already
+                deadline = time() + self.dbmanager.flushinterval
+                while not self.stopped and not self.replay and len(self.pending) < self.dbmanager.flushthreshold and time() < deadline:
+                    self.condition.wait(deadline - time())
+                if self.replay:
+                    batch = dict((extension, (presence, None)) for extension, presence in self.latest.items())
+                    self.replay = False
+                else:
+                    batch = self.pending
+                self.pending = {}
+                events = self.events
+                self.events = []
+                stopped = self.stopped
+            if batch and not self._write(batch, events) and not stopped:
+                # Waits before reconnecting, the replay afterwards covers this batch and anything lost with the connection
+                with self.condition:
+                    self.replay = True
+                self._requeue_events(events)
+                self.stopevent.wait(self.backoff)
+                self.backoff = min(self.backoff * 2, 30)
+            if stopped:
+                break
+        self._close()
+
+    def _connect(self):
+        self.conn = self.dbmanager.connect()
+        try:
+            cur = self.conn.cursor()
+            cur.execute(self.dbmanager.presenceStatement(cur))
+            self.conn.commit()
+            cur.close()
+        except psycopg2.Error:
+            # Without the prepared statement the connection is no use, the next write starts over
+            self._close()
+            raise
+
+    def _requeue_events(self, events):
+        # Transitions have no replay, they wait in front of the newer ones and the oldest go if there is no room
+        with self.condition:
+            self.events = events + self.events
+            if len(self.events) > self.dbmanager.eventlogsize:
+                self.droppedevents += len(self.events) - self.dbmanager.eventlogsize
+                del self.events[:len(self.events) - self.dbmanager.eventlogsize]
+
+    def _write(self, batch, events=()):
+        # Writes the batch with the prepared UPDATE, then copies the transitions, returns False if the connection failed
+        metrics = self.dbmanager.subscriptionapp.metrics
+        try:
+            if self.conn is None:
+                self._connect()
+            cur = self.conn.cursor()
+            cur.execute("EXECUTE update_presence (%s::text[], %s::text[])", (list(batch.keys()), [presence for presence, received in batch.values()]))
+            self.conn.commit()
+            cur.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            self.dbmanager.subscriptionapp.output.error('Writing presence to the database failed: %s', e)
+            metrics.dberrors.inc()
+            self._close()
+            return False
+        except psycopg2.Error as e:
+            # The database refused the data itself, writing it again would only fail again
+            self.dbmanager.subscriptionapp.output.error('Dropped presence the database refused: %s: %s', e, batch)
+            metrics.dberrors.inc()
+            self._rollback()
+            self._drop(batch)
+            if events and self.conn is not None:
+                self._copy_events(events)
+            return True
+        self.backoff = 1
+        if metrics.enabled:
+            committed = time()
+            metrics.batchsize.observe(len(batch))
+            for presence, received in batch.values():
+                if received is not None:
+                    metrics.commitlatency.observe(committed - received)
+        if events:
+            self._copy_events(events)
+        return True
+
+    def _copy_events(self, events):
+        # Runs in its own transaction so a broken event log never holds up the presence writes
+        try:
+            cur = self.conn.cursor()
+            cur.copy_expert(self.dbmanager.eventlogquery, self._format_events(events))
+            self.conn.commit()
+            cur.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            self.dbmanager.subscriptionapp.output.error('Writing the event log failed: %s', e)
+            self._close()
+            self._requeue_events(events)
+        except psycopg2.Error as e:
+            self.dbmanager.subscriptionapp.output.error('Dropped %d transitions the event log refused: %s', len(events), e)
+            self._rollback()
+
+    def _format_events(self, events):
+        # Renders the transitions as COPY text, which is much cheaper for Postgres to take in than one INSERT each
+        data = StringIO()
+        if self.droppedevents:
+            self.dbmanager.subscriptionapp.output.warning('The event log queue was full, %d transitions were dropped', self.droppedevents)
+            self.droppedevents = 0
+        for changed, extension, previouscode, code, peer in events:
+            data.write('%s\t%s\t%s\t%s\t%s+00\n' % (copy_field(extension), copy_field(code_name(previouscode)), copy_field(code_name(code)), copy_field(peer), datetime.utcfromtimestamp(changed).isoformat()))
+        data.seek(0)
+        return data
+
+    def _rollback(self):
+        if self.conn is not None:
+            try:
+                self.conn.rollback()
+            except psycopg2.Error:
+                self._close()
+
+    def _drop(self, batch):
+        # Keeps a replay from writing the refused presence again, unless a newer one came in meanwhile
+        with self.condition:
+            for extension, (presence, received) in batch.items():
+                if self.latest.get(extension) == presence:
+                    del self.latest[extension]
+
+    def _close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.conn = None
+
+
+# Waits for Postgres notifications about the extension table and reloads the extensions when one arrives
+class ExtensionListener(Thread):
+
+    def __init__(self, dbmanager):
+        Thread.__init__(self)
+        self.dbmanager = dbmanager
+        self.daemon = True
+        self.stopped = Event()
+        self.conn = None
+        # Waits this long after a notification so a bulk import only causes one reload
+        self.settledelay = 0.5
+
+    def run(self):
+        nextresync = time() + self.dbmanager.resyncinterval
+        while not self.stopped.is_set():
+            try:
+                if self.conn is None and self.dbmanager.listenchannel:
+                    self._listen()
+                if self.conn is not None:
+                    changed = self._wait(max(nextresync - time(), 0))
+                else:
+                    changed = False
+                    self.stopped.wait(max(nextresync - time(), 0))
+                if self.stopped.is_set():
+                    break
+                if changed or time() >= nextresync:
+                    self.dbmanager.loadExtensions()
+                    nextresync = time() + self.dbmanager.resyncinterval
+            except psycopg2.Error as e:
+                self.dbmanager.subscriptionapp.output.error('Extension listener lost the database: %s', e)
+                self._close()
+                self.stopped.wait(5)
+
+    def stop(self):
+        self.stopped.set()
+        self._close()
+
+    def _listen(self):
+        self.conn = psycopg2.connect(host = self.dbmanager.host, database = self.dbmanager.database, user = self.dbmanager.user, password = self.dbmanager.password, port = self.dbmanager.port)
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = self.conn.cursor()
+        cur.execute(psycopg2.sql.SQL("LISTEN {}").format(psycopg2.sql.Identifier(self.dbmanager.listenchannel)))
+        cur.close()
+
+    def _wait(self, timeout):
+        # Returns True once one or more notifications have arrived
+        if not select.select([self.conn], [], [], timeout)[0]:
+            return False
+        self.conn.poll()
+        # Lets the rest of a burst of changes arrive before reloading
+        self.stopped.wait(self.settledelay)
+        self.conn.poll()
+        del self.conn.notifies[:]
+        return True
+
+    def _close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.conn = None
@@ -0,0 +1,110 @@
+import json
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+from sipsimple.threading import run_in_twisted_thread
+
+
+def _entry_data(extension, entry):
+    if entry is None:
+        return {"extension": extension, "status": None, "changed": None}
+    return {"extension": extension, "status": entry.status, "changed": entry.changed}
+
+
+# Serves the presence cache over HTTP, a JSON snapshot plus a Server-Sent Events stream of changes
+class PresenceFeed(object):
+
+    def __init__(self, presencecache, port, interface, alloworigin):
+        self.presencecache = presencecache
+        self.port = port
+        self.interface = interface
+        self.alloworigin = alloworigin # Value of Access-Control-Allow-Origin, blank leaves the header out
+        self.clients = set()
+        self.keepalive = LoopingCall(self._keepalive)
+        self.listeningport = None
+
+    def start(self):
+        root = Resource()
+        root.putChild('presence', SnapshotResource(self))
+        root.putChild('events', EventsResource(self))
+        self.listeningport = reactor.listenTCP(self.port, Site(root), interface=self.interface)
+        self.keepalive.start(15, now=False)
+        self.presencecache.add_listener(self._changed)
+
+    def stop(self):
+        if self.keepalive.running:
+            self.keepalive.stop()
+        for request in list(self.clients):
+            request.finish()
+        if self.listeningport is not None:
+            self.listeningport.stopListening()
+            self.listeningport = None
+
+    def set_headers(self, request, contenttype):
+        request.setHeader('Content-Type', contenttype)
+        request.setHeader('Cache-Control', 'no-cache')
+        if self.alloworigin:
+            request.setHeader('Access-Control-Allow-Origin', self.alloworigin)
+
+    def write_event(self, request, version, extension, entry):
+        request.write('id: %s-%d\nevent: presence\ndata: %s\n\n' % (self.presencecache.epoch, version, json.dumps(_entry_data(extension, entry))))
+
+    @run_in_twisted_thread
+    def _changed(self, extension, entry, version):
+        for request in self.clients:
+            self.write_event(request, version, extension, entry)
+
+    def _keepalive(self):
+        # Comment lines keep proxies from closing idle streams
+        for request in self.clients:
+            request.write(': keepalive\n\n')
+
+
+# GET /presence, every extension's current presence and the version to resume /events from
+class SnapshotResource(Resource):
+    isLeaf = True
+
+    def __init__(self, feed):
+        Resource.__init__(self)
+        self.feed = feed
+
+    def render_GET(self, request):
+        cache = self.feed.presencecache
+        with cache.lock:
+            version = cache.version
+            presence = dict((extension, {"status": entry.status, "changed": entry.changed, "version": entry.version}) for extension, entry in cache.entries.items())
+        self.feed.set_headers(request, 'application/json')
+        return json.dumps({"epoch": cache.epoch, "version": version, "presence": presence})
+
+
+# GET /events, streams changes after the Last-Event-ID header or the since query argument
+class EventsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, feed):
+        Resource.__init__(self)
+        self.feed = feed
+
+    def render_GET(self, request):
+        cache = self.feed.presencecache
+        # Cursors are epoch-version, a bare version is still taken but can not tell a restart apart
+        epoch, _, cursor = (request.getHeader('Last-Event-ID') or request.args.get('since', [''])[0]).rpartition('-')
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            # Without a cursor the stream starts at the current state, fetch /presence first for a snapshot
+            epoch = ''
+            cursor = cache.version
+        self.feed.set_headers(request, 'text/event-stream')
+        if (epoch and epoch != cache.epoch) or cursor > cache.version:
+            # The cursor is from before a restart, the client has to drop what it has and take the full state
+            request.write('event: reset\ndata: {}\n\n')
+            cursor = 0
+        for version, extension, entry in cache.changes_since(cursor):
+            self.feed.write_event(request, version, extension, entry)
+        self.feed.clients.add(request)
+        request.notifyFinish().addBoth(lambda result: self.feed.clients.discard(request))
+        return NOT_DONE_YET
@@ -2,12 +2,26 @@ import datetime
 import os
 import random
 import select
+import signal
 import sys
 import termios
 import urllib
 import json
 import configparser
 import dbmanager
+import httpfeed
+import messagebatcher
+import metrics
+import outputlog
+import pidfparser
+import presencecache
+import refreshpolicy
+import resourcelist
+import routecache
+import sharding
+import statesnapshot
+import subscriptionrecovery
+import subscriptionscheduler
 
 from collections import deque
 from optparse import OptionParser
@@ -16,10 +30,10 @@ from time import time
 
 from application import log
 from application.notification import IObserver, NotificationCenter, NotificationData
-from application.python.queue import EventQueue
 from eventlib.twistedutil import join_reactor
 from twisted.internet import reactor
 from twisted.internet.error import ReactorNotRunning
+from twisted.internet.task import LoopingCall
 from zope.interface import implements
 
 from sipsimple.account import Account, AccountManager, BonjourAccount
@@ -27,7 +41,7 @@ from sipsimple.application import SIPApplication
 from sipsimple.lookup import DNSLookup
 from sipsimple.configuration import ConfigurationError, ConfigurationManager
 from sipsimple.configuration.settings import SIPSimpleSettings
-from sipsimple.core import ContactHeader, Engine, FromHeader, RouteHeader, SIPCoreError, SIPURI, Subscription, ToHeader, Route, Message
+from sipsimple.core import ContactHeader, Engine, FromHeader, Header, RouteHeader, SIPCoreError, SIPURI, Subscription, ToHeader, Route, Message
 from sipsimple.payloads import ParserError
 from sipsimple.payloads import rpid # needed to register RPID extensions
 from sipsimple.payloads.pidf import Device, Person, Service, PIDF, PIDFDocument
@@ -53,8 +67,8 @@ class InputThread(Thread):
         while True:
             for char in self._getchars():
                 if char == "\x04":
-                    # CTRL + D ends the application
-                    self.application.stop()
+                    # CTRL + D ends the application, stopping touches state that belongs to the reactor thread
+                    reactor.callFromThread(self.application.stop)
                     sys.exit()
                 elif char == "\x0A":
                     # ENTER updates the extensions list from the database
@@ -89,7 +103,10 @@ class InputThread(Thread):
 class SubscriptionApplication(object):
     implements(IObserver)
 
-    def __init__(self):
+    # Class that stores presence and loads the extensions, the benchmarks swap in an in-memory one
+    databasemanager = dbmanager.DatabaseManager
+
+    def __init__(self, shard=None, shards=1, sipport=None, daemon=False):
         # Loads the config file
         config = configparser.ConfigParser()
         try:
@@ -99,18 +116,94 @@ class SubscriptionApplication(object):
             return
         self.account_name = config["SIPCONFIG"]["account_name"]
         self.target = None
-        self.input = InputThread(self)
-        self.output = EventQueue(self._write)
+        # Workers of a sharded setup only watch their share of the extensions and have no console
+        self.shard = shard
+        self.ring = sharding.HashRing(range(shards)) if shard is not None else None
+        self.sipport = sipport
+        # Daemons run without a terminal, they are stopped with SIGTERM instead of CTRL + D
+        daemon = daemon or config.getboolean('LOGCONFIG', 'daemon', fallback=False)
+        self.input = InputThread(self) if shard is None and not daemon else None
+        logfile = config.get('LOGCONFIG', 'file', fallback='')
+        if logfile and shard is not None:
+            logfile = '%s.%d' % (logfile, shard)
+        self.output = outputlog.OutputLog(outputlog.LEVELS[config.get('LOGCONFIG', 'level', fallback='info').lower()],
+                                          logfile,
+                                          not (daemon and logfile),
+                                          config.getint('LOGCONFIG', 'rate_limit', fallback=10))
         self.logger = Logger(sip_to_stdout=False, pjsip_to_stdout=False, notifications_to_stdout=False)
         self.account = None
-        self.subscriptions = []
+        self.subscriptions = {} # Active subscriptions keyed by the watched extension
         self.subscriptionqueue = []
-        self.statusdict = {}
+        self.endingsubscriptions = set() # Subscriptions that were ended on purpose
+        self.startingends = set() # Subscriptions dropped while their initial SUBSCRIBE was out, ended as soon as they start
+        self.presencecache = presencecache.PresenceCache()
+        self.subscriptionstates = {} # Subscription to the last state it reported
         self.stopping = False
-        self.lastmessage = None
+        self.metrics = metrics.Metrics(config.getboolean('METRICSCONFIG', 'enabled', fallback=False))
+        self.metricsserver = None
+        if self.metrics.enabled:
+            self.metricsserver = metrics.MetricsServer(self.metrics,
+                                                       config.getint('METRICSCONFIG', 'port', fallback=9108) + (shard or 0),
+                                                       config.get('METRICSCONFIG', 'interface', fallback='127.0.0.1'),
+                                                       config.getint('METRICSCONFIG', 'dump_interval', fallback=60),
+                                                       self.output)
         self.commandsystemenabled = bool(config['SIPCONFIG']['commands'])
+        self.resourcelist = config.get('SIPCONFIG', 'resource_list', fallback='') or None # Server side resource list to subscribe to instead of every extension
+        if self.shard is not None:
+            # A resource list is already a single dialog, so workers subscribe to their extensions directly
+            self.resourcelist = None
+        self.resourcelistworking = False # Set once the resource list delivered a NOTIFY
+        self.dbextensions = []
+        self.messagebatcher = messagebatcher.MessageBatcher(self._send_statusupdate,
+                                                            config.getint('SIPCONFIG', 'message_window', fallback=200) / 1000.0,
+                                                            config.getint('SIPCONFIG', 'message_max_size', fallback=1000))
+        self.presencefeed = None
+        self.shardreporter = None
+        if self.shard is not None:
+            # The supervisor serves the unified presence of all workers
+            self.shardreporter = sharding.ShardReporter(self.presencecache)
+        elif config.getboolean('HTTPCONFIG', 'enabled', fallback=False):
+            self.presencefeed = httpfeed.PresenceFeed(self.presencecache,
+                                                      config.getint('HTTPCONFIG', 'port', fallback=8088),
+                                                      config.get('HTTPCONFIG', 'interface', fallback='127.0.0.1'),
+                                                      config.get('HTTPCONFIG', 'allow_origin', fallback=''))
+        self.parsecache = pidfparser.PIDFParseCache(config.getint('SIPCONFIG', 'parse_cache_size', fallback=4096), self._parse_pidf)
+        self.refreshjitter = config.getfloat('SIPCONFIG', 'refresh_jitter', fallback=0.2) # Fraction of the refresh interval that refreshes are spread over
+        # A minimum of 0 is replaced by the account's subscribe_interval once the account is loaded
+        self.refreshpolicy = refreshpolicy.RefreshPolicy(config.getint('SIPCONFIG', 'refresh_min', fallback=0),
+                                                         config.getint('SIPCONFIG', 'refresh_max', fallback=3600),
+                                                         config.getint('SIPCONFIG', 'refresh_idle_after', fallback=900))
+        self.refreshreviewer = LoopingCall(self._review_refresh_intervals)
+        self.refreshintervals = {} # Extension to the refresh interval of its started subscription, before jitter
+        self.startingintervals = {} # Subscription whose initial SUBSCRIBE is out to the refresh interval it was created with
+        self.replacing = {} # Extension to its old subscription, kept running until the replacement with a shorter refresh starts
+        subscriberate = config.getfloat('SIPCONFIG', 'subscribe_rate', fallback=50)
+        subscribeburst = config.getint('SIPCONFIG', 'subscribe_burst', fallback=50)
+        subscribemaxinflight = config.getint('SIPCONFIG', 'subscribe_max_inflight', fallback=100)
+        # Any of these below their minimum would stall the scheduler for good
+        if subscriberate <= 0:
+            raise RuntimeError("subscribe_rate has to be above 0, it is %s" % subscriberate)
+        if subscribeburst < 1 or subscribemaxinflight < 1:
+            raise RuntimeError("subscribe_burst and subscribe_max_inflight have to be at least 1, they are %d and %d" % (subscribeburst, subscribemaxinflight))
+        self.scheduler = subscriptionscheduler.SubscriptionScheduler(self._start_subscription, subscriberate, subscribeburst, subscribemaxinflight, self.output)
+
+        self.routecache = routecache.RouteCache(config.getint('SIPCONFIG', 'route_ttl', fallback=300))
+        self.lookingup = False # Set while a DNS lookup for the proxy is running
+        self.recovering = {} # Extensions waiting to be resubscribed, to their delayed call
+        self.recovery = subscriptionrecovery.SubscriptionRecovery(config.getfloat('SIPCONFIG', 'recovery_base_delay', fallback=1),
+                                                                  config.getfloat('SIPCONFIG', 'recovery_max_delay', fallback=300),
+                                                                  config.getint('SIPCONFIG', 'recovery_max_failures', fallback=5))
+        self.wantedextensions = set()
+
+        # Warm restart state, written periodically and read back at startup
+        self.snapshotpath = config.get('SNAPSHOTCONFIG', 'file', fallback='')
+        if self.snapshotpath and self.shard is not None:
+            self.snapshotpath = '%s.%d' % (self.snapshotpath, self.shard)
+        self.snapshotinterval = config.getint('SNAPSHOTCONFIG', 'interval', fallback=30)
+        self.snapshotfreshage = config.getint('SNAPSHOTCONFIG', 'fresh_age', fallback=300) # Extensions confirmed more recently than this are resubscribed in the background
+        self.snapshotsaver = LoopingCall(self._save_snapshot)
+        self.freshextensions = set()
 
-        self._subscription_routes = None
         self._subscription_timeout = 0.0
         self._subscription_wait = 0.5
 
@@ -119,16 +212,12 @@ class SubscriptionApplication(object):
         notification_center = NotificationCenter()
         notification_center.add_observer(self, sender=account_manager)
         notification_center.add_observer(self, sender=engine)
-        notification_center.add_observer(self, sender=self.input)
+        if self.input is not None:
+            notification_center.add_observer(self, sender=self.input)
         notification_center.add_observer(self, name='SIPEngineGotMessage')
 
         log.level.current = log.level.WARNING
 
-    def _write(self, message):
-        if isinstance(message, unicode):
-            message = message.encode(sys.getfilesystemencoding())
-        sys.stdout.write(message+'\n')
-
     def run(self):
         account_manager = AccountManager()
         configuration = ConfigurationManager()
@@ -160,7 +249,9 @@ class SubscriptionApplication(object):
                 raise RuntimeError("No enabled account that matches %s was found. Available and enabled accounts: %s" % (self.account_name, ", ".join(sorted(account.id for account in account_manager.get_accounts() if account.enabled))))
             self.account = possible_accounts[0]
             self.account.presence.enabled = True
-            self.account.save()
+            if self.shard is None:
+                # Workers share the configuration storage, so only a standalone process saves to it
+                self.account.save()
         if self.account is None:
             raise RuntimeError("Unknown account %s. Available accounts: %s" % (self.account_name, ', '.join(account.id for account in account_manager.iter_accounts())))
         for account in account_manager.iter_accounts():
@@ -168,8 +259,10 @@ class SubscriptionApplication(object):
                 account.sip.register = False
             else:
                 account.enabled = False
-        self.output.put('Using account %s' % self.account.id)
+        self.output.info('Using account %s', self.account.id)
         settings = SIPSimpleSettings()
+        if not self.refreshpolicy.mininterval:
+            self.refreshpolicy.mininterval = self.account.sip.subscribe_interval
 
         # start logging
         self.logger.start()
@@ -177,10 +270,10 @@ class SubscriptionApplication(object):
         # start the SIPSIMPLE engine
         engine.start(
             auto_sound=False,
-            events={'presence': [PIDFDocument.content_type]},
-            udp_port=settings.sip.udp_port if "udp" in settings.sip.transport_list else None,
-            tcp_port=settings.sip.tcp_port if "tcp" in settings.sip.transport_list else None,
-            tls_port=settings.sip.tls_port if "tls" in settings.sip.transport_list else None,
+            events={'presence': [PIDFDocument.content_type, resourcelist.MULTIPART_CONTENT_TYPE, resourcelist.RLMI_CONTENT_TYPE]},
+            udp_port=(self.sipport or settings.sip.udp_port) if "udp" in settings.sip.transport_list else None,
+            tcp_port=(0 if self.sipport else settings.sip.tcp_port) if "tcp" in settings.sip.transport_list else None,
+            tls_port=(0 if self.sipport else settings.sip.tls_port) if "tls" in settings.sip.transport_list else None,
             tls_verify_server=self.account.tls.verify_server,
             tls_ca_file=os.path.expanduser(settings.tls.ca_list) if settings.tls.ca_list else None,
             tls_cert_file=os.path.expanduser(self.account.tls.certificate) if self.account.tls.certificate else None,
@@ -193,21 +286,48 @@ class SubscriptionApplication(object):
         )
 
         # start the input thread
-        self.input.start()
+        if self.input is not None:
+            self.input.start()
+
+        # Restores the last known state so presence is there before the first NOTIFYs arrive
+        if self.snapshotpath:
+            self._load_snapshot()
+            self.snapshotsaver.start(self.snapshotinterval, now=False)
+
+        # Moves subscriptions between refresh intervals as their extensions go idle or get busy
+        self.refreshreviewer.start(self.refreshpolicy.reviewinterval, now=False)
 
         # Sets up the database manager for adding subscriptions
-        self.db = dbmanager.DatabaseManager(self)
+        self.db = self.databasemanager(self)
         self.db.loadExtensions()
+        # Keeps the subscriptions in sync with the database from now on
+        self.db.startListening()
+
+        # Serves presence to web clients straight from memory
+        if self.presencefeed is not None:
+            self.presencefeed.start()
+
+        # Exposes the pipeline metrics
+        if self.metricsserver is not None:
+            self.metrics.gauge('presence_subscriptions', 'Subscriptions by their last reported state', self._count_subscription_states, label='state')
+            self.metrics.gauge('presence_subscribe_backlog', 'SUBSCRIBEs waiting on the scheduler', lambda: self.scheduler.backlog)
+            self.metrics.gauge('presence_subscribe_inflight', 'Initial SUBSCRIBE transactions waiting on a response', lambda: len(self.scheduler.inflight))
+            self.metrics.gauge('presence_db_queue_depth', 'Extensions waiting to be written to the database', lambda: len(self.db.writer.pending))
+            self.metricsserver.start()
+
+        if self.input is None:
+            # Twisted installs its own handlers when the reactor starts, these replace them with a clean unsubscribe
+            reactor.callWhenRunning(self._install_signal_handlers)
 
         # start twisted
         try:
             reactor.run()
         finally:
-            self.input.stop()
+            if self.input is not None:
+                self.input.stop()
 
         # stop the output
         self.output.stop()
-        self.output.join()
         
         # closes the database connection
         self.db.destroyDBConnection()
@@ -218,65 +338,232 @@ class SubscriptionApplication(object):
 
     def stop(self):
         self.stopping = True
-        for subscription in self.subscriptions:
-            if subscription is not None and subscription.state.lower() in ('accepted', 'pending', 'active'):
-                subscription.end(timeout=1)
-            else:
-                engine = Engine()
-                engine.stop()
+        self.scheduler.clear()
+        if self.snapshotpath:
+            reactor.callFromThread(self._save_snapshot)
+        self.messagebatcher.flush()
+        if self.presencefeed is not None:
+            reactor.callFromThread(self.presencefeed.stop)
+        for delayedcall in self.recovering.values():
+            if delayedcall.active():
+                delayedcall.cancel()
+        self.recovering = {}
+        for subscription in self.subscriptions.values() + self.replacing.values():
+            self._end_subscription(subscription)
+        self.subscriptions = {}
+        self.replacing = {}
+        # The engine stops right away if nothing has to be unsubscribed, otherwise after the last one ends
+        if not self.endingsubscriptions:
+            engine = Engine()
+            engine.stop()
+
+    def _install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+    def _handle_signal(self, signum, frame):
+        # The first signal unsubscribes from everything before stopping, a second one stops right away
+        if self.stopping:
+            reactor.callFromThread(self._stop_reactor)
+        else:
+            self.output.info('Got signal %d, stopping', signum)
+            reactor.callFromThread(self.stop)
+
+    def _jittered_refresh(self, interval):
+        return max(int(interval * random.uniform(1 - self.refreshjitter, 1)), 1)
+
+    def _review_refresh_intervals(self):
+        # Changes are spread over the review period so a quiet night does not turn into a burst of SUBSCRIBEs
+        for extension in list(self.subscriptions):
+            interval = self.refreshpolicy.interval(self.presencecache.entries.get(extension))
+            if extension in self.refreshintervals and interval != self.refreshintervals[extension]:
+                reactor.callLater(random.uniform(0, self.refreshpolicy.reviewinterval), self._change_refresh_interval, extension, interval)
+
+    def _change_refresh_interval(self, extension, interval):
+        subscription = self.subscriptions.get(extension)
+        if self.stopping or subscription is None or subscription.state.lower() != 'active' or self.refreshintervals.get(extension) == interval:
+            return
+        self.output.limited('refresh', outputlog.DEBUG, 'Resubscribing %s to refresh every %d seconds', extension, interval)
+        # The refresh interval is fixed when a subscription is created, so it is replaced by a new one
+        # that picks up the interval from the policy, behind any new subscriptions in the scheduler
+        if interval < self.refreshintervals.get(extension, interval):
+            # The extension got busy, the old subscription keeps delivering NOTIFYs until the replacement has started
+            if extension not in self.replacing:
+                self.replacing[extension] = subscription
+                self.scheduler.add(ToHeader.new(subscription.to_header))
+            return
+        # Idle extensions can do without presence for the moment the replacement waits behind any new subscriptions
+        self.subscriptions.pop(extension, None)
+        self._end_subscription(subscription)
+        self.scheduler.add(ToHeader.new(subscription.to_header), background=True)
+
+    def _end_subscription(self, subscription):
+        if subscription is None:
+            return
+        state = subscription.state.lower()
+        if state in ('accepted', 'pending', 'active'):
+            self.endingsubscriptions.add(subscription)
+            subscription.end(timeout=1)
+        elif state != 'terminated':
+            # The initial SUBSCRIBE is still out and can not be ended yet, its NOTIFYs are ignored until it starts and is ended
+            self.startingends.add(subscription)
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, None)
         if handler is not None:
             handler(notification)
 
+    @run_in_twisted_thread
     def _NH_SIPSubscriptionDidStart(self, notification):
         route = Route(notification.sender.route_header.uri.host, notification.sender.route_header.uri.port, notification.sender.route_header.uri.parameters.get('transport', 'udp'))
-        self._subscription_routes = None
         self._subscription_wait = 0.5
-        self.output.put('Subscription succeeded at %s:%d;transport=%s' % (route.address, route.port, route.transport))
+        self.scheduler.done(notification.sender)
+        self.routecache.succeeded(route)
+        if notification.sender in self.startingends:
+            self.startingends.discard(notification.sender)
+            self._end_subscription(notification.sender)
+            return
+        self.recovery.succeeded(str(notification.sender.to_header.uri.user))
+        if notification.sender in self.startingintervals:
+            self.refreshintervals[str(notification.sender.to_header.uri.user)] = self.startingintervals.pop(notification.sender)
+        if self.replacing.get(str(notification.sender.to_header.uri.user)) not in (None, notification.sender):
+            # The replacement with the shorter refresh is up, the old subscription can go
+            self._end_subscription(self.replacing.pop(str(notification.sender.to_header.uri.user)))
+        self.output.limited('subscription', outputlog.INFO, 'Subscription succeeded at %s:%d;transport=%s', route.address, route.port, route.transport)
+
+    def _count_subscription_states(self):
+        counts = {}
+        for state in self.subscriptionstates.values():
+            counts[state] = counts.get(state, 0) + 1
+        return counts
 
+    @run_in_twisted_thread
     def _NH_SIPSubscriptionChangedState(self, notification):
+        self.subscriptionstates[notification.sender] = notification.data.state.lower()
         route = Route(notification.sender.route_header.uri.host, notification.sender.route_header.uri.port, notification.sender.route_header.uri.parameters.get('transport', 'udp'))
         if notification.data.state.lower() == "pending":
-            self.output.put('Subscription pending at %s:%d;transport=%s' % (route.address, route.port, route.transport))
+            self.output.limited('subscription', outputlog.INFO, 'Subscription pending at %s:%d;transport=%s', route.address, route.port, route.transport)
         elif notification.data.state.lower() == "active":
-            self.output.put('Subscription active at %s:%d;transport=%s' % (route.address, route.port, route.transport))
+            self.output.limited('subscription', outputlog.INFO, 'Subscription active at %s:%d;transport=%s', route.address, route.port, route.transport)
 
+    @run_in_twisted_thread
     def _NH_SIPSubscriptionDidEnd(self, notification):
         notification_center = NotificationCenter()
         notification_center.remove_observer(self, sender=notification.sender)
+        self.scheduler.done(notification.sender)
+        self.subscriptionstates.pop(notification.sender, None)
+        self.startingintervals.pop(notification.sender, None)
+        self.startingends.discard(notification.sender)
+        if self.subscriptions.get(str(notification.sender.to_header.uri.user)) is notification.sender and str(notification.sender.to_header.uri.user) not in self.replacing:
+            self.refreshintervals.pop(str(notification.sender.to_header.uri.user), None)
         route = Route(notification.sender.route_header.uri.host, notification.sender.route_header.uri.port, notification.sender.route_header.uri.parameters.get('transport', 'udp'))
-        if (route.uri.user):
-            self.statusdict.pop(str(route.uri.user)) # removes them from the status list
-        self.output.put('Unsubscribed from %s:%d;transport=%s' % (route.address, route.port, route.transport))
-        self.stop()
+        extension = str(notification.sender.to_header.uri.user)
+        self.output.limited('unsubscribe', outputlog.INFO, 'Unsubscribed %s from %s:%d;transport=%s', extension, route.address, route.port, route.transport)
+        if notification.sender in self.endingsubscriptions:
+            # Ended by a reconcile or by stopping
+            self.endingsubscriptions.discard(notification.sender)
+            if self.stopping and not self.endingsubscriptions:
+                engine = Engine()
+                engine.stop()
+        elif self.replacing.get(extension) is notification.sender:
+            # The old subscription of a replacement ended by itself, the replacement is already on its way
+            del self.replacing[extension]
+        elif self.subscriptions.get(extension) is not notification.sender or self.stopping:
+            # Already replaced or on its way out
+            pass
+        elif extension in self.replacing:
+            # The replacement failed, the old subscription carries on with its longer refresh
+            self.subscriptions[extension] = self.replacing.pop(extension)
+        elif notification.data.code in (408, 503):
+            # The proxy did not answer, moves the subscription to the next route once this one backs off
+            self.subscriptions.pop(extension, None)
+            delay = self.routecache.failed(route)
+            self.output.limited('route failure', outputlog.WARNING, 'Route %s:%d;transport=%s failed, resubscribing %s in %.1f seconds', route.address, route.port, route.transport, extension, delay)
+            self.recovering[extension] = reactor.callLater(delay, self._recover_subscription, notification.sender.to_header)
+            if self.routecache.expired:
+                self._lookup_routes()
+        elif self.resourcelist and extension == self._extension_user(self.resourcelist) and not self.resourcelistworking:
+            # The server does not support the list, falls back to a subscription per extension
+            self.output.warning('Resource list %s is not available, subscribing to every extension instead', self.resourcelist)
+            self.subscriptions.pop(extension, None)
+            self.resourcelist = None
+            self._reconcile_extensions(self.dbextensions)
+        else:
+            # The server or the phone ended a subscription that is still wanted, only this extension is resubscribed
+            self.subscriptions.pop(extension, None)
+            delay = self.recovery.failed(extension)
+            if self.recovery.exhausted(extension) and not self.resourcelist:
+                # Keeps failing, most likely nothing is registered, so it is shown as such and retried less often
+                self._set_presence(extension, 'unregistered', time())
+            self.output.limited('resubscribe', outputlog.INFO, 'Subscription to %s ended with %s, resubscribing in %.1f seconds', extension, notification.data.code, delay)
+            self.recovering[extension] = reactor.callLater(delay, self._recover_subscription, notification.sender.to_header)
+
+    @run_in_twisted_thread
+    def _recover_subscription(self, toheader):
+        extension = str(toheader.uri.user)
+        self.recovering.pop(extension, None)
+        if extension in self.wantedextensions and extension not in self.subscriptions and not self.stopping:
+            self.scheduler.add(ToHeader.new(toheader))
 
     def _NH_SIPSubscriptionGotNotify(self, notification):
+        if notification.sender in self.startingends or notification.sender in self.endingsubscriptions:
+            # The extension is no longer wanted, a NOTIFY on the way out must not bring it back
+            return
         if notification.data.content_type == PIDFDocument.content_type:
-            self.output.put('\nReceived NOTIFY:')
+            from_header = FromHeader.new(notification.data.from_header)
+            self._process_pidf(str(from_header.uri.user), notification.data.body, notification.sender)
+        elif notification.data.content_type == resourcelist.MULTIPART_CONTENT_TYPE:
+            # A resource list NOTIFY carries a PIDF document for each extension that changed
+            self.resourcelistworking = True
+            contenttype = notification.data.headers.get('Content-Type')
             try:
-                pidf = PIDF.parse(notification.data.body)
-            except ParserError, e:
-                self.output.put('Got illegal PIDF document: %s\n%s' % (str(e), notification.data.body))
-            else:
-                from_header = FromHeader.new(notification.data.from_header)
-                extension = str(from_header.uri.user)
-                status = self._display_pidf(pidf).lower()
-                self.statusdict[extension] = status
-                if (notification.sender.route_header):
-                    route = Route(notification.sender.route_header.uri.host, notification.sender.route_header.uri.port, notification.sender.route_header.uri.parameters.get('transport', 'udp'))
-                    datajson = {"data": json.dumps(self.statusdict)} # This is no longer used as the presences are pulled from the DB
-                    newjson = json.dumps({"to": "all", "type": "statusupdate", 'data': extension})
-                    if (datajson != self.lastmessage): # makes sure stuff doesn't happen multiple times from multiple same notifies
-                        if (self.commandsystemenabled):
-                           self._send_message(self.account.uri, newjson, route) # sends a statusupdate sip command if the system is enabled
-                        self.db.updatePresence(extension, status)
-                        self.lastmessage = datajson
+                parts = resourcelist.resource_parts(notification.data.content_type, contenttype.parameters, notification.data.body)
+            except Exception, e:
+                self.output.limited('illegal resource list', outputlog.WARNING, 'Got illegal resource list NOTIFY: %s', e)
+                return
+            for uri, body in parts:
+                self._process_pidf(self._extension_user(uri), body, notification.sender)
+
+    def _process_pidf(self, extension, body, subscription):
+        received = time()
+        self.metrics.notifies.inc()
+        try:
+            status = self.parsecache.status(body)
+        except ParserError, e:
+            self.output.limited('illegal PIDF', outputlog.WARNING, 'Got illegal PIDF document: %s\n%s', e, body)
+            return
+        self.metrics.parselatency.observe(time() - received)
+        self.output.limited('NOTIFY', outputlog.INFO, 'Received NOTIFY for %s: %s', extension, status)
+        if self._set_presence(extension, status, received) is None:
+            self.metrics.duplicates.inc()
+
+    def _set_presence(self, extension, status, received):
+        # Refresh NOTIFYs repeat the current state, only a real change of this extension goes further
+        previous = self.presencecache.get(extension)
+        entry = self.presencecache.update(extension, status)
+        if entry is None:
+            return None
+        self.db.logTransition(extension, previous, entry.status, entry.changed)
+        if self.commandsystemenabled:
+            self.messagebatcher.add(extension) # sends a statusupdate sip command if the system is enabled
+        self.db.updatePresence(extension, entry.status, received)
+        # An idle extension that gets busy again goes back to short refreshes right away
+        if extension in self.refreshintervals:
+            interval = self.refreshpolicy.interval(entry)
+            if interval < self.refreshintervals[extension]:
+                reactor.callFromThread(self._change_refresh_interval, extension, interval)
+        return entry
 
     def _NH_DNSLookupDidFail(self, notification):
-        self.output.put('DNS lookup failed: %s' % notification.data.error)
-        timeout = random.uniform(1.0, 2.0)
+        self.output.warning('DNS lookup failed: %s', notification.data.error)
+        self.lookingup = False
+        # Stale routes are still better than none, the lookup is retried with a growing delay
+        if self.routecache.routes:
+            self._dispatch_subscription_queue()
+        timeout = random.uniform(self._subscription_wait, 2 * self._subscription_wait)
+        self._subscription_wait = min(self._subscription_wait * 2, 30)
+        if self.subscriptionqueue or not self.routecache.routes:
+            reactor.callLater(timeout, self._lookup_routes)
 
     @run_in_twisted_thread
     def _NH_SIPEngineDidEnd(self, notification):
@@ -284,47 +571,159 @@ class SubscriptionApplication(object):
 
     @run_in_twisted_thread
     def _NH_SIPEngineDidFail(self, notification):
-        self.output.put('Engine failed.')
+        self.output.error('Engine failed.')
         self._stop_reactor()
 
     def _NH_SIPEngineGotException(self, notification):
-        self.output.put('An exception occured within the SIP core:\n'+notification.data.traceback)
+        self.output.error('An exception occured within the SIP core:\n%s', notification.data.traceback)
 
     def _NH_DNSLookupDidSucceed(self, notification):
-        # create subscriptions for everyone in the queue and register to get notifications from it
-        self._subscription_routes = deque(notification.data.result)
-        route = self._subscription_routes[0]
-        route_header = RouteHeader(route.uri)
+        self.lookingup = False
+        self._subscription_wait = 0.5
+        self.routecache.update(notification.data.result)
+        self._dispatch_subscription_queue()
+
+    def _dispatch_subscription_queue(self):
+        # hands everyone in the queue to the scheduler, which paces the actual SUBSCRIBEs
         for waitingsubscription in self.subscriptionqueue:
-            # Creates a subscription for the waiting subscription
-            newsubscription = Subscription(waitingsubscription.uri,
-                                            FromHeader(self.account.uri, self.account.display_name),
-                                            waitingsubscription,
-                                            ContactHeader(self.account.contact[route]),
-                                            "presence",
-                                            route_header,
-                                            credentials=self.account.credentials,
-                                            refresh=self.account.sip.subscribe_interval)
-            # Sets up an event listener for this new subscription
-            notification_center = NotificationCenter()
-            notification_center.add_observer(self, sender=newsubscription)
-            # Starts the subscribe
-            newsubscription.subscribe(timeout=5)
-            # Adds this subscription to the active subscriptions list
-            self.subscriptions.append(newsubscription)
-            # Debug stuff
-            self.output.put("Started new subscription with " + waitingsubscription.uri.user)
+            # Extensions with fresh state from the snapshot wait behind the ones that have none
+            extension = str(waitingsubscription.uri.user)
+            self.scheduler.add(waitingsubscription, background=extension in self.freshextensions)
+            self.freshextensions.discard(extension)
         # Clears all of the waiting subscriptions
         self.subscriptionqueue = []
 
+    def _start_subscription(self, waitingsubscription):
+        # Creates a subscription for the waiting subscription, called by the scheduler
+        if self.stopping:
+            return None
+        route = self.routecache.current()
+        if route is None:
+            # Waits for the routes to be looked up again
+            self.subscriptionqueue.append(waitingsubscription)
+            self._lookup_routes()
+            return None
+        route_header = RouteHeader(route.uri)
+        # Each subscription gets its own refresh interval so refreshes do not stay in lockstep
+        if self.resourcelist:
+            interval = self.account.sip.subscribe_interval
+        else:
+            interval = self.refreshpolicy.interval(self.presencecache.entries.get(str(waitingsubscription.uri.user)))
+        refresh = self._jittered_refresh(interval)
+        newsubscription = Subscription(waitingsubscription.uri,
+                                        FromHeader(self.account.uri, self.account.display_name),
+                                        waitingsubscription,
+                                        ContactHeader(self.account.contact[route]),
+                                        "presence",
+                                        route_header,
+                                        credentials=self.account.credentials,
+                                        refresh=refresh)
+        # Sets up an event listener for this new subscription
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, sender=newsubscription)
+        # Starts the subscribe, asking for RFC 4662 list handling if this is the resource list
+        if self.resourcelist and str(waitingsubscription.uri.user) == self._extension_user(self.resourcelist):
+            newsubscription.subscribe(extra_headers=[Header('Supported', 'eventlist')], timeout=5)
+        else:
+            newsubscription.subscribe(timeout=5)
+        # Adds this subscription to the active subscriptions
+        self.subscriptions[str(waitingsubscription.uri.user)] = newsubscription
+        if not self.resourcelist:
+            # Only counts as this extension's interval once the subscription starts
+            self.startingintervals[newsubscription] = interval
+        # Debug stuff
+        self.output.limited('SUBSCRIBE', outputlog.INFO, 'Started new subscription with %s', waitingsubscription.uri.user)
+        return newsubscription
+
     def _stop_reactor(self):
         try:
             reactor.stop()
         except ReactorNotRunning:
             pass
 
+    @run_in_twisted_thread
+    def _reconcile_extensions(self, extensions, complete=True):
+        # Diffs the extensions from the database against the active and queued subscriptions
+        if self.ring is not None:
+            # Keeps only the extensions the hash ring gives to this worker
+            extensions = [extension for extension in extensions if self.ring.owner(self._extension_user(extension)) == self.shard]
+        if not complete:
+            # Part of the list while it is still being read, subscribes to the new extensions and leaves removals for the whole list
+            if not self.resourcelist:
+                self._add_extensions(extensions)
+            return
+        self.dbextensions = extensions
+        if self.resourcelist:
+            # One subscription to the server side list carries every extension
+            extensions = [self.resourcelist]
+        wanted = dict((self._extension_user(extension), extension) for extension in extensions)
+        queued = set(str(toheader.uri.user) for toheader in self.subscriptionqueue)
+        queued.update(str(toheader.uri.user) for toheader in self.scheduler.pending())
+        queued.update(self.recovering)
+        self.wantedextensions = set(wanted)
+        known = set(self.subscriptions) | queued
+        added = [wanted[user] for user in sorted(set(wanted) - known)]
+        removed = known - set(wanted)
+        if removed:
+            # Ends only the subscriptions that are no longer in the database
+            self.subscriptionqueue = [toheader for toheader in self.subscriptionqueue if str(toheader.uri.user) not in removed]
+            self.scheduler.discard(lambda toheader: str(toheader.uri.user) in removed)
+            for user in removed:
+                self._end_subscription(self.subscriptions.pop(user, None))
+                self._end_subscription(self.replacing.pop(user, None))
+                delayedcall = self.recovering.pop(user, None)
+                if delayedcall is not None and delayedcall.active():
+                    delayedcall.cancel()
+                self.recovery.forget(user)
+                self.refreshintervals.pop(user, None)
+                self.presencecache.remove(user)
+                self.db.removeExtension(user)
+        if added:
+            self._setup_new_subscriptions(added)
+        if added or removed:
+            self.output.info('Reconciled extensions with the database: %d added, %d removed', len(added), len(removed))
+
+    def _add_extensions(self, extensions):
+        queued = set(str(toheader.uri.user) for toheader in self.subscriptionqueue)
+        queued.update(str(toheader.uri.user) for toheader in self.scheduler.pending())
+        known = set(self.subscriptions) | queued | set(self.recovering)
+        added = []
+        for extension in extensions:
+            user = self._extension_user(extension)
+            if user not in known:
+                known.add(user)
+                added.append(extension)
+            self.wantedextensions.add(user)
+        if added:
+            self._setup_new_subscriptions(added)
+            self.output.info('Subscribing to %d new extensions while the database is read', len(added))
+
+    def _load_snapshot(self):
+        state = statesnapshot.load(self.snapshotpath)
+        if state is None:
+            return
+        now = time()
+        self.presencecache.restore(dict((extension, tuple(entry)) for extension, entry in state["presence"].items()), state["version"])
+        self.freshextensions = set(extension for extension, entry in state["presence"].items() if now - entry[3] < self.snapshotfreshage)
+        if state["routes"] and state["routes_expire"] > now:
+            self.routecache.update([Route(address, port, transport) for address, port, transport in state["routes"]], state["routes_expire"] - now)
+        self.output.info('Restored %d extensions from the snapshot saved %d seconds ago, %d of them are fresh', len(state["presence"]), now - state["saved"], len(self.freshextensions))
+        # Starts subscribing before the database has answered, the reconcile after loading the extensions fixes any difference
+        self._reconcile_extensions(state["extensions"])
+
+    def _save_snapshot(self):
+        try:
+            statesnapshot.save(self.snapshotpath, self.presencecache, self.routecache, self.dbextensions)
+        except (IOError, OSError), e:
+            self.output.error('Could not save the snapshot: %s', e)
+
+    def _extension_user(self, extension):
+        # The user part of an extension from the database, which is what subscriptions are keyed by
+        if extension.startswith('sip:') or extension.startswith('sips:'):
+            extension = extension.split(':', 1)[1]
+        return extension.split('@', 1)[0]
+
     def _setup_new_subscriptions(self, urilist):
-        # TODO: Add check to see active subscriptions so it doesn't subscribe twice
         # sets up a new subscription with the given list of URI's
         for uri in urilist:
             tempuri = uri
@@ -338,10 +737,22 @@ class SubscriptionApplication(object):
                 try:
                     tempuri = ToHeader(SIPURI.parse(tempuri))
                 except SIPCoreError:
-                    self.output.put('Illegal SIP URI: %s' % tempuri)
-                    return 1
+                    self.output.limited('illegal URI', outputlog.WARNING, 'Illegal SIP URI: %s', tempuri)
+                    continue
             self.subscriptionqueue.append(tempuri)
-        #reactor.callLater(0, self._subscribe)
+        if not self.subscriptionqueue:
+            return
+        # Cached routes skip the DNS lookup entirely
+        if not self.routecache.expired:
+            self._dispatch_subscription_queue()
+        else:
+            self._lookup_routes()
+
+    @run_in_twisted_thread
+    def _lookup_routes(self):
+        if self.lookingup or self.stopping:
+            return
+        self.lookingup = True
         settings = SIPSimpleSettings()
 
         self._subscription_timeout = time() + 30
@@ -352,13 +763,16 @@ class SubscriptionApplication(object):
         proxyuri = None
         if self.account.sip.outbound_proxy is not None:
             proxyuri = SIPURI(host=self.account.sip.outbound_proxy.host, port=self.account.sip.outbound_proxy.port, parameters={'transport': self.account.sip.outbound_proxy.transport})
-        elif self.account.sip.always_use_my_proxy:
+        elif self.account.sip.always_use_my_proxy or not self.subscriptionqueue:
             proxyuri = SIPURI(host=self.account.id.domain)
         else:
             proxyuri = self.subscriptionqueue[0].uri
         lookup.lookup_sip_proxy(proxyuri, settings.sip.transport_list)
-        
-        
+
+    def _parse_pidf(self, body):
+        # Full parse, only used for the documents the fast path in pidfparser can not handle
+        return self._display_pidf(PIDF.parse(body))
+
     def _display_pidf(self, pidf):
         persons = {}
         printed_sep = True
@@ -369,13 +783,11 @@ class SubscriptionApplication(object):
         if len(persons) == 0:
             if list(pidf.notes):
                 returnstring = "%s" % pidf.notes[0]
-                self.output.put(returnstring + "\n")
                 return returnstring
         else:
             for person in persons.values():
                 newlist = self._format_person(person, pidf)
                 returnstring = ":".join(newlist)
-                self.output.put(returnstring + "\n")
                 return returnstring
 
     def _format_person(self, person, pidf):
@@ -405,7 +817,12 @@ class SubscriptionApplication(object):
         if from_header.display_name:
             identity = '"%s" <%s>' % (from_header.display_name, identity)
         body = notification.data.body
-        self.output.put("Got MESSAGE from '%s', Content-Type: %s\n%s\n" % (identity, content_type, body))
+        self.output.info("Got MESSAGE from '%s', Content-Type: %s\n%s\n", identity, content_type, body)
+
+    def _send_statusupdate(self, messagebody):
+        # Sends a batch of changed extensions to the command extension
+        self.metrics.messages.inc()
+        self._send_message(self.account.uri, messagebody, self.routecache.current())
 
     def _send_message(self, targeturi, messagebody, route):
         ## sends a message to the target URI
@@ -417,7 +834,7 @@ class SubscriptionApplication(object):
             identity = str(self.account.uri)
             if self.account.display_name:
                 identity = '"%s" <%s>' % (self.account.display_name, identity)
-            self.output.put("Sending MESSAGE from '%s' to '%s' using proxy %s" % (identity, targeturi, route))
+            self.output.limited('MESSAGE', outputlog.INFO, "Sending MESSAGE from '%s' to '%s' using proxy %s", identity, targeturi, route)
             message_request = Message(FromHeader(self.account.uri, self.account.display_name), ToHeader(uri), RouteHeader(route.uri), 'text/plain', messagebody, self.account.credentials, [])
             notification_center.add_observer(self, sender=message_request)
             message_request.send()
@@ -427,9 +844,20 @@ class SubscriptionApplication(object):
 
 if __name__ == "__main__":
     # Main Execution Section
+    parser = OptionParser()
+    parser.add_option('--shard', type='int', dest='shard', default=None, help='run as the worker for this shard, used by the supervisor')
+    parser.add_option('--shards', type='int', dest='shards', default=1, help='number of shards the extensions are split into')
+    parser.add_option('--sip-port', type='int', dest='sipport', default=None, help='UDP port for SIP, overriding the sipclient settings')
+    parser.add_option('--daemon', action='store_true', dest='daemon', default=False, help='run without the console, stop with SIGTERM')
+    options, args = parser.parse_args()
     try:
-        application = SubscriptionApplication()
-        return_code = application.run()
+        supervisor = sharding.ShardSupervisor()
+        if options.shard is None and supervisor.workers > 1:
+            # Splits the extensions over several worker processes
+            return_code = supervisor.run()
+        else:
+            application = SubscriptionApplication(options.shard, options.shards, options.sipport, options.daemon)
+            return_code = application.run()
     except RuntimeError, e:
         print "Error: %s" % str(e)
         sys.exit(1)
@@ -0,0 +1,51 @@
+import json
+
+from twisted.internet import reactor
+
+from sipsimple.threading import run_in_twisted_thread
+
+
+# Collects changed extensions over a short window and sends them as one statusupdate MESSAGE
+class MessageBatcher(object):
+
+    def __init__(self, send, window, maxsize):
+        self.send = send # Sends the JSON body of a batch
+        self.window = window # Seconds that changes are collected for
+        self.maxsize = maxsize # Bytes a MESSAGE body can grow to before it is sent early
+        self.extensions = []
+        self.pending = set()
+        self.size = len(self._body([]))
+        self.flusher = None
+
+    @run_in_twisted_thread
+    def add(self, extension):
+        if extension in self.pending:
+            return
+        itemsize = len(json.dumps(extension)) + (2 if self.extensions else 0)
+        # Sends what was collected so far if this extension would push the body past its limit
+        if self.extensions and self.size + itemsize > self.maxsize:
+            self.flush()
+            itemsize = len(json.dumps(extension))
+        self.extensions.append(extension)
+        self.pending.add(extension)
+        self.size += itemsize
+        if self.window <= 0:
+            self.flush()
+        elif self.flusher is None:
+            self.flusher = reactor.callLater(self.window, self.flush)
+
+    @run_in_twisted_thread
+    def flush(self):
+        if self.flusher is not None and self.flusher.active():
+            self.flusher.cancel()
+        self.flusher = None
+        if not self.extensions:
+            return
+        body = self._body(self.extensions)
+        self.extensions = []
+        self.pending = set()
+        self.size = len(self._body([]))
+        self.send(body)
+
+    def _body(self, extensions):
+        return json.dumps({"to": "all", "type": "statusupdate", "data": extensions})
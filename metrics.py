@@ -0,0 +1,171 @@
+import bisect
+import outputlog
+
+from threading import Lock
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+# Bucket bounds in seconds for the latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Bucket bounds for the database batch sizes
+BATCH_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+# Stands in for every metric when metrics are disabled, so the hot path only pays for an empty call
+class NullMetric(object):
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, '', self.value)]
+
+
+# A gauge that is read from a callback when it is rendered, the callback returns a number or a dict of label to number
+class Gauge(object):
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback, label=None):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.label = label
+
+    def samples(self):
+        value = self.callback()
+        if self.label is None:
+            return [(self.name, '', value)]
+        return [(self.name, '{%s="%s"}' % (self.label, labelvalue), count) for labelvalue, count in sorted(value.items())]
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        samples = []
+        cumulative = 0
+        for bound, bucketcount in zip(self.buckets, counts):
+            cumulative += bucketcount
+            samples.append((self.name + '_bucket', '{le="%s"}' % bound, cumulative))
+        samples.append((self.name + '_bucket', '{le="+Inf"}', count))
+        samples.append((self.name + '_sum', '', total))
+        samples.append((self.name + '_count', '', count))
+        return samples
+
+
+# Counters and histograms for the NOTIFY to database pipeline
+class Metrics(object):
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.registered = []
+        self.notifies = self._register(Counter('presence_notifies_total', 'PIDF documents received in NOTIFYs'))
+        self.duplicates = self._register(Counter('presence_notify_duplicates_total', 'NOTIFYs suppressed because the status did not change'))
+        self.parselatency = self._register(Histogram('presence_parse_seconds', 'Time from receiving a NOTIFY to having its status', LATENCY_BUCKETS))
+        self.commitlatency = self._register(Histogram('presence_notify_commit_seconds', 'Time from receiving a NOTIFY to committing its status to the database', LATENCY_BUCKETS))
+        self.batchsize = self._register(Histogram('presence_db_batch_size', 'Extensions written per database transaction', BATCH_BUCKETS))
+        self.dberrors = self._register(Counter('presence_db_write_errors_total', 'Database writes that failed'))
+        self.messages = self._register(Counter('presence_messages_sent_total', 'Statusupdate MESSAGEs sent to the command extension'))
+
+    def _register(self, metric):
+        if not self.enabled:
+            return NullMetric()
+        self.registered.append(metric)
+        return metric
+
+    def gauge(self, name, help, callback, label=None):
+        self._register(Gauge(name, help, callback, label))
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in self.registered:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # One line version of the counters for the periodic stats dump
+        return ', '.join('%s%s=%s' % (name, labels, value) for metric in self.registered if metric.kind != 'histogram' for name, labels, value in metric.samples())
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.metrics.render()
+
+
+# Serves /metrics for Prometheus and writes a stats line every dump interval
+class MetricsServer(object):
+
+    def __init__(self, metrics, port, interface, dumpinterval, output):
+        self.metrics = metrics
+        self.port = port
+        self.interface = interface
+        self.dumpinterval = dumpinterval
+        self.output = output
+        self.dumper = LoopingCall(self._dump)
+        self.lastnotifies = 0
+
+    def start(self):
+        if self.port:
+            root = Resource()
+            root.putChild('metrics', MetricsResource(self.metrics))
+            reactor.listenTCP(self.port, Site(root), interface=self.interface)
+        if self.dumpinterval > 0:
+            self.dumper.start(self.dumpinterval, now=False)
+
+    def _dump(self):
+        notifies = self.metrics.notifies.value
+        rate = (notifies - self.lastnotifies) / float(self.dumpinterval)
+        self.lastnotifies = notifies
+        if self.output.enabled(outputlog.INFO):
+            self.output.info('Stats: %.1f NOTIFYs/s, %s', rate, self.metrics.summary())
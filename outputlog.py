@@ -0,0 +1,110 @@
+import sys
+
+from datetime import datetime
+from threading import Lock
+from time import time
+
+from application.python.queue import EventQueue
+from twisted.internet.task import LoopingCall
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVELNAMES = dict((level, name.upper()) for name, level in LEVELS.items())
+
+
+# Levelled output written from its own thread, messages are only formatted there and only if their level is enabled
+class OutputLog(object):
+
+    def __init__(self, level=INFO, path='', console=True, ratelimit=10):
+        self.level = level
+        self.console = console
+        self.file = open(path, 'a', 1) if path else None
+        self.ratelimit = ratelimit # Lines per second each kind of limited line is allowed, 0 lets every line through
+        self.windows = {} # Kind of line to [start of its second, lines written in it, lines suppressed, level]
+        self.lock = Lock()
+        self.queue = EventQueue(self._write)
+        # Reports suppressed lines even when no more lines of their kind come
+        self.reporter = LoopingCall(self._report_suppressed)
+
+    def start(self):
+        self.queue.start()
+        self.reporter.start(1, now=False)
+
+    def stop(self):
+        if self.reporter.running:
+            self.reporter.stop()
+        self._report_suppressed(force=True)
+        self.queue.stop()
+        self.queue.join()
+        if self.file is not None:
+            self.file.close()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def debug(self, message, *args):
+        if DEBUG >= self.level:
+            self.queue.put((DEBUG, message, args))
+
+    def info(self, message, *args):
+        if INFO >= self.level:
+            self.queue.put((INFO, message, args))
+
+    def warning(self, message, *args):
+        if WARNING >= self.level:
+            self.queue.put((WARNING, message, args))
+
+    def error(self, message, *args):
+        if ERROR >= self.level:
+            self.queue.put((ERROR, message, args))
+
+    def put(self, message):
+        # Same as info, for the parts that were handed the plain output queue
+        self.info(message)
+
+    def limited(self, kind, level, message, *args):
+        # For lines written once per NOTIFY or SUBSCRIBE, past the rate limit they are only counted
+        if level < self.level:
+            return
+        if self.ratelimit > 0:
+            now = time()
+            with self.lock:
+                window = self.windows.get(kind)
+                if window is None or now - window[0] >= 1:
+                    if window is not None:
+                        self._put_suppressed(kind, window)
+                    window = self.windows[kind] = [now, 0, 0, level]
+                if window[1] >= self.ratelimit:
+                    window[2] += 1
+                    return
+                window[1] += 1
+        self.queue.put((level, message, args))
+
+    def _report_suppressed(self, force=False):
+        now = time()
+        with self.lock:
+            for kind, window in list(self.windows.items()):
+                if force or now - window[0] >= 1:
+                    self._put_suppressed(kind, window)
+                    del self.windows[kind]
+
+    def _put_suppressed(self, kind, window):
+        if window[2]:
+            self.queue.put((window[3], '(%d more %s lines were suppressed)', (window[2], kind)))
+
+    def _write(self, item):
+        level, message, args = item
+        if args:
+            message = message % args
+        if isinstance(message, unicode):
+            message = message.encode(sys.getfilesystemencoding())
+        if self.console:
+            if level >= WARNING:
+                sys.stdout.write('%s: %s\n' % (LEVELNAMES[level], message))
+            else:
+                sys.stdout.write(message + '\n')
+        if self.file is not None:
+            self.file.write('%s %s %s\n' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], LEVELNAMES[level], message))
@@ -0,0 +1,57 @@
+import hashlib
+
+from collections import OrderedDict
+from threading import Lock
+from xml.etree import cElementTree as ElementTree
+
+PIDF_NAMESPACE = 'urn:ietf:params:xml:ns:pidf'
+DATA_MODEL_NAMESPACE = 'urn:ietf:params:xml:ns:pidf:data-model'
+
+
+class FastPathError(Exception):
+    pass
+
+
+def extract_status(body):
+    # Pulls the status out of the person and presence notes, the same way SubscriptionApplication._display_pidf does
+    root = ElementTree.fromstring(body)
+    if root.tag != '{%s}presence' % PIDF_NAMESPACE:
+        raise FastPathError('Not a PIDF document: %s' % root.tag)
+    pidfnotes = [note.text or '' for note in root.findall('{%s}note' % PIDF_NAMESPACE)]
+    persons = root.findall('{%s}person' % DATA_MODEL_NAMESPACE)
+    if not persons:
+        if pidfnotes:
+            return pidfnotes[0]
+        return None
+    personnotes = [note.text or '' for note in persons[0].findall('{%s}note' % DATA_MODEL_NAMESPACE)]
+    return ":".join(personnotes or pidfnotes)
+
+
+# Remembers the status of recently seen PIDF bodies, since refresh NOTIFYs repeat the same body
+class PIDFParseCache(object):
+
+    def __init__(self, size, fallback):
+        self.size = size
+        self.fallback = fallback # Full parser for the bodies the fast path can not handle
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def status(self, body):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        digest = hashlib.sha1(body).digest()
+        with self.lock:
+            if digest in self.entries:
+                # Moves it to the back so it is the last to be evicted
+                status = self.entries.pop(digest)
+                self.entries[digest] = status
+                return status
+        try:
+            status = extract_status(body)
+        except (SyntaxError, FastPathError):
+            status = self.fallback(body)
+        with self.lock:
+            self.entries[digest] = status
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return status
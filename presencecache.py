@@ -0,0 +1,94 @@
+from threading import Lock
+from time import time
+
+
+# A single extension's presence as it is known by the cache
+class PresenceEntry(object):
+    __slots__ = ('status', 'changed', 'version', 'seen')
+
+    def __init__(self, status, changed, version, seen=None):
+        self.status = status
+        self.changed = changed
+        self.version = version
+        self.seen = changed if seen is None else seen # Last time a NOTIFY confirmed the status
+
+
+# Authoritative in-memory presence of every watched extension
+class PresenceCache(object):
+
+    def __init__(self):
+        self.entries = {}
+        self.removed = {} # Extensions that were removed, to the version they were removed at
+        # Increases with every change, so each entry's version also orders it against all others
+        self.version = 0
+        # Identifies this run, versions are only comparable between clients and the cache within one epoch
+        self.epoch = '%x' % int(time() * 1000)
+        self.lock = Lock()
+        self.listeners = [] # Called with the extension, its new entry or None once it is removed, and the version of the change
+
+    @staticmethod
+    def normalize(status):
+        # Lowercases the status and squashes whitespace so refreshes with cosmetic differences match
+        if status is None:
+            return None
+        return " ".join(status.split()).lower()
+
+    def update(self, extension, status):
+        # Returns the changed entry, or None if the extension already had this status
+        status = self.normalize(status)
+        if status is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(extension)
+            if entry is not None and entry.status == status:
+                entry.seen = time()
+                return None
+            self.version += 1
+            entry = PresenceEntry(status, time(), self.version)
+            self.entries[extension] = entry
+            self.removed.pop(extension, None)
+        self._notify(extension, entry, entry.version)
+        return entry
+
+    def get(self, extension):
+        entry = self.entries.get(extension)
+        if entry is None:
+            return None
+        return entry.status
+
+    def remove(self, extension):
+        with self.lock:
+            entry = self.entries.pop(extension, None)
+            if entry is None:
+                return None
+            self.version += 1
+            self.removed[extension] = version = self.version
+        self._notify(extension, None, version)
+        return entry
+
+    def restore(self, entries, version):
+        # Loads entries from a snapshot, given as extension to (status, changed, version, seen)
+        with self.lock:
+            for extension, (status, changed, entryversion, seen) in entries.items():
+                self.entries[extension] = PresenceEntry(status, changed, entryversion, seen)
+            self.version = max(self.version, version)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def changes_since(self, version):
+        # Every extension that changed or was removed after the version, oldest change first
+        with self.lock:
+            changes = [(entry.version, extension, entry) for extension, entry in self.entries.items() if entry.version > version]
+            changes.extend((removedversion, extension, None) for extension, removedversion in self.removed.items() if removedversion > version)
+        changes.sort(key=lambda change: change[0])
+        return changes
+
+    def snapshot(self):
+        # Plain copy of extension to status, for anything that wants the old statusdict layout
+        with self.lock:
+            return dict((extension, entry.status) for extension, entry in self.entries.items())
+
+    def _notify(self, extension, entry, version):
+        for listener in self.listeners:
+            listener(extension, entry, version)
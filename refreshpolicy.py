@@ -0,0 +1,33 @@
+from time import time
+
+# Status codes from presencecodes.txt that mean the extension is in a call right now
+BUSY_CODES = ('talk', 'call', 'ring')
+
+
+# Picks each subscription's refresh interval from its presence, idle extensions are refreshed less often
+class RefreshPolicy(object):
+
+    def __init__(self, mininterval, maxinterval, idleafter):
+        self.mininterval = mininterval # Seconds between refreshes of busy and recently changed extensions
+        self.maxinterval = maxinterval
+        self.idleafter = idleafter # Seconds without a change before an extension counts as idle
+        self.reviewinterval = 60 # Seconds between checks of every subscription against the policy
+
+    def interval(self, entry):
+        # Returns the refresh interval for a cache entry, or for an extension that has no status yet
+        if entry is None or self.maxinterval <= self.mininterval:
+            return self.mininterval
+        code = entry.status.split(' ', 1)[0]
+        if code in BUSY_CODES:
+            return self.mininterval
+        idle = time() - entry.changed
+        if idle < self.idleafter:
+            return self.mininterval
+        if code == 'unregistered':
+            return self.maxinterval
+        # Doubles for every idle period, so an extension that just went quiet is not refreshed rarely right away
+        interval = self.mininterval
+        while idle >= self.idleafter and interval < self.maxinterval:
+            interval *= 2
+            idle -= self.idleafter
+        return min(interval, self.maxinterval)
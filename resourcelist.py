@@ -0,0 +1,34 @@
+import email
+
+from xml.etree import cElementTree as ElementTree
+
+# Content types used by RFC 4662 resource list NOTIFYs
+MULTIPART_CONTENT_TYPE = 'multipart/related'
+RLMI_CONTENT_TYPE = 'application/rlmi+xml'
+PIDF_CONTENT_TYPE = 'application/pidf+xml'
+RLMI_NAMESPACE = 'urn:ietf:params:xml:ns:rlmi'
+
+
+def resource_parts(contenttype, parameters, body):
+    # Splits a multipart/related NOTIFY body into (resource uri, PIDF body) pairs, the boundary comes from the Content-Type parameters
+    header = 'Content-Type: %s%s' % (contenttype, ''.join('; %s="%s"' % (name, str(value).strip('"')) for name, value in sorted(parameters.items())))
+    message = email.message_from_string('%s\r\n\r\n%s' % (header, body))
+    if not message.is_multipart():
+        return []
+    parts = message.get_payload()
+    # The RLMI document maps the Content-ID of every part to the resource it describes
+    resources = {}
+    for part in parts:
+        if part.get_content_type() == RLMI_CONTENT_TYPE:
+            rlmi = ElementTree.fromstring(part.get_payload(decode=True))
+            for resource in rlmi.findall('{%s}resource' % RLMI_NAMESPACE):
+                for instance in resource.findall('{%s}instance' % RLMI_NAMESPACE):
+                    if instance.get('cid'):
+                        resources[instance.get('cid')] = resource.get('uri')
+            break
+    pidfparts = []
+    for part in parts:
+        cid = (part.get('Content-ID') or '').strip().strip('<>')
+        if cid in resources and part.get_content_type() == PIDF_CONTENT_TYPE:
+            pidfparts.append((resources[cid], part.get_payload(decode=True)))
+    return pidfparts
@@ -0,0 +1,55 @@
+from threading import Lock
+from time import time
+
+
+# Resolved proxy routes shared by every subscription and message, with a backoff for routes that failed
+class RouteCache(object):
+
+    def __init__(self, ttl, minbackoff=1.0, maxbackoff=60.0):
+        self.ttl = ttl # Seconds a lookup result is used before looking the proxy up again
+        self.minbackoff = minbackoff
+        self.maxbackoff = maxbackoff
+        self.routes = []
+        self.expires = 0
+        self.failures = {} # Route key to (failure count, time it can be used again)
+        self.lock = Lock()
+
+    @staticmethod
+    def key(route):
+        return (route.address, route.port, route.transport)
+
+    def update(self, routes, ttl=None):
+        with self.lock:
+            self.routes = list(routes)
+            self.expires = time() + (self.ttl if ttl is None else ttl)
+            # Forgets failures of routes the lookup no longer returns
+            keys = set(self.key(route) for route in self.routes)
+            self.failures = dict((key, failure) for key, failure in self.failures.items() if key in keys)
+
+    @property
+    def expired(self):
+        return not self.routes or time() >= self.expires
+
+    def current(self):
+        # The first route that is not backing off, or the one that comes out of backoff soonest
+        with self.lock:
+            if not self.routes:
+                return None
+            now = time()
+            for route in self.routes:
+                failure = self.failures.get(self.key(route))
+                if failure is None or failure[1] <= now:
+                    return route
+            return min(self.routes, key=lambda route: self.failures[self.key(route)][1])
+
+    def failed(self, route):
+        # Puts the route into backoff and returns the delay before it is tried again
+        with self.lock:
+            count = self.failures.get(self.key(route), (0, 0))[0] + 1
+            delay = min(self.minbackoff * 2 ** (count - 1), self.maxbackoff)
+            self.failures[self.key(route)] = (count, time() + delay)
+            return delay
+
+    def succeeded(self, route):
+        with self.lock:
+            self.failures.pop(self.key(route), None)
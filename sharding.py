@@ -0,0 +1,155 @@
+import bisect
+import configparser
+import hashlib
+import json
+import os
+import signal
+import sys
+
+from time import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import ProcessProtocol
+
+import httpfeed
+import presencecache
+
+# File descriptor that workers report presence changes to the supervisor on
+STATUS_FD = 3
+
+
+# Consistent hash ring, adding or removing an extension only ever affects where that extension goes
+class HashRing(object):
+
+    def __init__(self, nodes, replicas=100):
+        self.ring = []
+        for node in nodes:
+            for replica in range(replicas):
+                self.ring.append((self._hash('%s-%d' % (node, replica)), node))
+        self.ring.sort()
+        self.keys = [point for point, node in self.ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        index = bisect.bisect(self.keys, self._hash(key)) % len(self.keys)
+        return self.ring[index][1]
+
+
+# Runs in a worker and sends every presence change to the supervisor
+class ShardReporter(object):
+
+    def __init__(self, presencecache):
+        presencecache.add_listener(self._changed)
+
+    def _changed(self, extension, entry, version):
+        line = json.dumps({"extension": extension, "status": entry.status if entry is not None else None}) + '\n'
+        os.write(STATUS_FD, line)
+
+
+# Splits the extensions over worker processes that each run their own engine, SIP port and database writer
+class ShardSupervisor(object):
+
+    def __init__(self):
+        config = configparser.ConfigParser()
+        try:
+            config.read('config.ini')
+        except Exception as e:
+            print("ERROR: " + e)
+            return
+        self.workers = config.getint('SHARDCONFIG', 'workers', fallback=1)
+        self.baseport = config.getint('SHARDCONFIG', 'base_port', fallback=5070) # Worker N listens for SIP on base_port + N
+        # The supervisor holds the unified presence of every worker and serves it if the HTTP feed is enabled
+        self.presencecache = presencecache.PresenceCache()
+        self.presencefeed = None
+        if config.getboolean('HTTPCONFIG', 'enabled', fallback=False):
+            self.presencefeed = httpfeed.PresenceFeed(self.presencecache,
+                                                      config.getint('HTTPCONFIG', 'port', fallback=8088),
+                                                      config.get('HTTPCONFIG', 'interface', fallback='127.0.0.1'),
+                                                      config.get('HTTPCONFIG', 'allow_origin', fallback=''))
+        self.processes = {}
+        self.stopping = False
+        self.stopped = None
+
+    def run(self):
+        for shard in range(self.workers):
+            self._spawn(shard, 1)
+        if self.presencefeed is not None:
+            self.presencefeed.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        reactor.run()
+        return 0
+
+    def stop(self):
+        # Holds the reactor's shutdown until every worker has ended, or for ten seconds at most
+        self.stopping = True
+        if not self.processes:
+            return None
+        self.stopped = Deferred()
+        for process in self.processes.values():
+            try:
+                process.signalProcess(signal.SIGTERM)
+            except Exception:
+                pass
+        reactor.callLater(10, self._stopped)
+        return self.stopped
+
+    def _stopped(self):
+        if self.stopped is not None and not self.stopped.called:
+            self.stopped.callback(None)
+
+    def _spawn(self, shard, restartdelay):
+        protocol = WorkerProtocol(self, shard, restartdelay)
+        arguments = [sys.executable, os.path.abspath(sys.argv[0]), '--shard', str(shard), '--shards', str(self.workers), '--sip-port', str(self.baseport + shard)]
+        self.processes[shard] = reactor.spawnProcess(protocol, sys.executable, arguments, env=os.environ, childFDs={0: 'w', 1: 'r', 2: 'r', STATUS_FD: 'r'})
+        print("Started worker %d on SIP port %d" % (shard, self.baseport + shard))
+
+    def worker_status(self, line):
+        try:
+            status = json.loads(line)
+        except ValueError:
+            return
+        if status["status"] is None:
+            self.presencecache.remove(status["extension"])
+        else:
+            self.presencecache.update(status["extension"], status["status"])
+
+    def worker_ended(self, shard, protocol):
+        self.processes.pop(shard, None)
+        if self.stopping:
+            if not self.processes:
+                self._stopped()
+            return
+        # Restarts the worker, backing off if it keeps dying right after starting
+        delay = protocol.restartdelay * 2 if time() - protocol.started < 60 else 1
+        delay = min(delay, 60)
+        print("Worker %d ended, restarting it in %d seconds" % (shard, delay))
+        reactor.callLater(delay, self._spawn, shard, delay)
+
+
+class WorkerProtocol(ProcessProtocol):
+
+    def __init__(self, supervisor, shard, restartdelay):
+        self.supervisor = supervisor
+        self.shard = shard
+        self.restartdelay = restartdelay
+        self.started = time()
+        self.buffers = {}
+
+    def childDataReceived(self, childfd, data):
+        # Splits the output into lines, status lines go to the supervisor and the rest is passed through
+        lines = (self.buffers.get(childfd, '') + data).split('\n')
+        self.buffers[childfd] = lines.pop()
+        for line in lines:
+            if childfd == STATUS_FD:
+                self.supervisor.worker_status(line)
+            elif childfd == 2:
+                sys.stderr.write('[worker %d] %s\n' % (self.shard, line))
+            else:
+                sys.stdout.write('[worker %d] %s\n' % (self.shard, line))
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self.shard, self)
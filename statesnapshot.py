@@ -0,0 +1,30 @@
+import json
+import os
+
+from time import time
+
+
+def save(path, presencecache, routecache, extensions):
+    # Writes the presence, routes and extensions compactly, through a temporary file so a crash never leaves half a snapshot
+    with presencecache.lock:
+        version = presencecache.version
+        presence = dict((extension, (entry.status, entry.changed, entry.version, entry.seen)) for extension, entry in presencecache.entries.items())
+    state = {"saved": time(),
+             "version": version,
+             "presence": presence,
+             "routes": [(route.address, route.port, route.transport) for route in routecache.routes],
+             "routes_expire": routecache.expires,
+             "extensions": sorted(extensions)}
+    temporarypath = path + '.tmp'
+    with open(temporarypath, 'w') as snapshotfile:
+        json.dump(state, snapshotfile, separators=(',', ':'))
+    os.rename(temporarypath, path)
+
+
+def load(path):
+    # Returns the saved state, or None if there is no usable snapshot
+    try:
+        with open(path) as snapshotfile:
+            return json.load(snapshotfile)
+    except (IOError, ValueError):
+        return None
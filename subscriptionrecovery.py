@@ -0,0 +1,35 @@
+import random
+
+from time import time
+
+
+# Tracks the failures of each watched extension's subscription and how long to wait before resubscribing it
+class SubscriptionRecovery(object):
+
+    def __init__(self, basedelay, maxdelay, maxfailures):
+        self.basedelay = float(basedelay)
+        self.maxdelay = float(maxdelay)
+        self.maxfailures = maxfailures # Consecutive failures after which the extension is given up on as unregistered
+        self.stableafter = 60 # Seconds a subscription has to last before its earlier failures are forgotten
+        self.failures = {} # Extension to its consecutive failures
+        self.started = {} # Extension to when its current subscription started
+
+    def succeeded(self, extension):
+        # The subscription started, it only counts as recovered once it lasts
+        self.started[extension] = time()
+
+    def failed(self, extension):
+        # Returns the delay before resubscribing, growing exponentially with half of it random so the retries spread out
+        started = self.started.pop(extension, None)
+        if started is not None and time() - started >= self.stableafter:
+            self.failures.pop(extension, None)
+        failures = self.failures[extension] = self.failures.get(extension, 0) + 1
+        delay = min(self.basedelay * 2 ** min(failures - 1, 30), self.maxdelay)
+        return delay * random.uniform(0.5, 1)
+
+    def exhausted(self, extension):
+        return self.failures.get(extension, 0) >= self.maxfailures
+
+    def forget(self, extension):
+        self.failures.pop(extension, None)
+        self.started.pop(extension, None)
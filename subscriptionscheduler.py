@@ -0,0 +1,88 @@
+from collections import deque
+from time import time
+
+from twisted.internet import reactor
+
+from sipsimple.threading import run_in_twisted_thread
+
+
+# Paces outgoing SUBSCRIBEs with a token bucket and a cap on the transactions in flight
+class SubscriptionScheduler(object):
+
+    def __init__(self, send, rate, burst, maxinflight, output):
+        self.send = send # Starts the subscription for a queued item and returns it
+        self.rate = float(rate) # SUBSCRIBEs per second
+        self.burst = float(burst) # SUBSCRIBEs that can go out at once after being idle
+        self.maxinflight = maxinflight
+        self.output = output
+        self.queue = deque()
+        self.backgroundqueue = deque() # Only sent once the queue is empty
+        self.inflight = set()
+        self.tokens = self.burst
+        self.lastfill = time()
+        self.drainer = None
+        self.reporter = None
+        self.reportinterval = 10
+
+    @property
+    def backlog(self):
+        return len(self.queue) + len(self.backgroundqueue)
+
+    def pending(self):
+        for item in self.queue:
+            yield item
+        for item in self.backgroundqueue:
+            yield item
+
+    @run_in_twisted_thread
+    def add(self, item, background=False):
+        if background:
+            self.backgroundqueue.append(item)
+        else:
+            self.queue.append(item)
+        self._schedule(0)
+        if self.reporter is None:
+            self.reporter = reactor.callLater(self.reportinterval, self._report)
+
+    @run_in_twisted_thread
+    def done(self, subscription):
+        # The initial SUBSCRIBE transaction of this subscription finished, one way or the other
+        if subscription in self.inflight:
+            self.inflight.discard(subscription)
+            self._schedule(0)
+
+    def discard(self, predicate):
+        # Drops the queued items the predicate matches, must be called from the twisted thread
+        self.queue = deque(item for item in self.queue if not predicate(item))
+        self.backgroundqueue = deque(item for item in self.backgroundqueue if not predicate(item))
+
+    def clear(self):
+        self.queue.clear()
+        self.backgroundqueue.clear()
+        if self.drainer is not None and self.drainer.active():
+            self.drainer.cancel()
+        self.drainer = None
+
+    def _schedule(self, delay):
+        if self.drainer is None and (self.queue or self.backgroundqueue):
+            self.drainer = reactor.callLater(delay, self._drain)
+
+    def _drain(self):
+        self.drainer = None
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.lastfill) * self.rate)
+        self.lastfill = now
+        while (self.queue or self.backgroundqueue) and self.tokens >= 1 and len(self.inflight) < self.maxinflight:
+            self.tokens -= 1
+            subscription = self.send(self.queue.popleft() if self.queue else self.backgroundqueue.popleft())
+            if subscription is not None:
+                self.inflight.add(subscription)
+        # A full in flight window is reopened by done() instead of a timer
+        if len(self.inflight) < self.maxinflight:
+            self._schedule(max(1 - self.tokens, 0) / self.rate)
+
+    def _report(self):
+        self.reporter = None
+        self.output.info('Subscription backlog: %d queued, %d in the background, %d in flight', len(self.queue), len(self.backgroundqueue), len(self.inflight))
+        if self.backlog or self.inflight:
+            self.reporter = reactor.callLater(self.reportinterval, self._report)
@@ -0,0 +1,31 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import sharding
+
+EXTENSIONS = [str(extension) for extension in range(1000, 3000)]
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_owner_is_stable(self):
+        owners = [sharding.HashRing([0, 1, 2]).owner(extension) for extension in EXTENSIONS]
+        self.assertEqual(owners, [sharding.HashRing([0, 1, 2]).owner(extension) for extension in EXTENSIONS])
+
+    def test_every_node_owns_extensions(self):
+        ring = sharding.HashRing([0, 1, 2])
+        self.assertEqual(set(ring.owner(extension) for extension in EXTENSIONS), set([0, 1, 2]))
+
+    def test_adding_node_only_moves_to_it(self):
+        before = sharding.HashRing([0, 1, 2])
+        after = sharding.HashRing([0, 1, 2, 3])
+        for extension in EXTENSIONS:
+            if before.owner(extension) != after.owner(extension):
+                self.assertEqual(after.owner(extension), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
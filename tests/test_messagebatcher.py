@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+import unittest
+
+from twisted.python import threadable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import messagebatcher
+
+
+class MessageBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        # Lets the run_in_twisted_thread methods run right away instead of waiting for a reactor
+        threadable.registerAsIOThread()
+        self.sent = []
+
+    def tearDown(self):
+        self.batcher.flush()
+
+    def start(self, window, maxsize):
+        self.batcher = messagebatcher.MessageBatcher(self.sent.append, window, maxsize)
+        return self.batcher
+
+    def data(self):
+        return [json.loads(body)["data"] for body in self.sent]
+
+    def test_collects_within_window(self):
+        batcher = self.start(60, 1300)
+        batcher.add('1001')
+        batcher.add('1002')
+        batcher.add('1001')
+        self.assertEqual(self.sent, [])
+        batcher.flush()
+        self.assertEqual(self.data(), [['1001', '1002']])
+
+    def test_splits_at_size(self):
+        maxsize = len(messagebatcher.MessageBatcher(None, 0, 0)._body(['1001', '1002']))
+        batcher = self.start(60, maxsize)
+        for extension in ['1001', '1002', '1003', '1004', '1005']:
+            batcher.add(extension)
+        batcher.flush()
+        self.assertEqual(self.data(), [['1001', '1002'], ['1003', '1004'], ['1005']])
+        for body in self.sent:
+            self.assertTrue(len(body) <= maxsize)
+
+    def test_without_window(self):
+        batcher = self.start(0, 1300)
+        batcher.add('1001')
+        batcher.add('1002')
+        self.assertEqual(self.data(), [['1001'], ['1002']])
+
+
+if __name__ == '__main__':
+    unittest.main()
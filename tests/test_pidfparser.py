@@ -0,0 +1,92 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import main
+import pidfparser
+
+PIDF_NOTES = """<?xml version="1.0" encoding="UTF-8"?>
+<presence xmlns="urn:ietf:params:xml:ns:pidf" entity="sip:1001@example.com">
+  <tuple id="t1">
+    <status><basic>open</basic></status>
+  </tuple>
+  <note>Available</note>
+</presence>"""
+
+PERSON_NOTES = """<?xml version="1.0" encoding="UTF-8"?>
+<presence xmlns="urn:ietf:params:xml:ns:pidf" xmlns:dm="urn:ietf:params:xml:ns:pidf:data-model" entity="sip:1001@example.com">
+  <tuple id="t1">
+    <status><basic>open</basic></status>
+  </tuple>
+  <dm:person id="p1">
+    <dm:note>Talk</dm:note>
+    <dm:note>1002</dm:note>
+  </dm:person>
+  <note>Available</note>
+</presence>"""
+
+PERSON_WITHOUT_NOTES = """<?xml version="1.0" encoding="UTF-8"?>
+<presence xmlns="urn:ietf:params:xml:ns:pidf" xmlns:dm="urn:ietf:params:xml:ns:pidf:data-model" entity="sip:1001@example.com">
+  <tuple id="t1">
+    <status><basic>open</basic></status>
+  </tuple>
+  <dm:person id="p1"/>
+  <note>Ring 1002</note>
+</presence>"""
+
+NO_NOTES = """<?xml version="1.0" encoding="UTF-8"?>
+<presence xmlns="urn:ietf:params:xml:ns:pidf" entity="sip:1001@example.com">
+  <tuple id="t1">
+    <status><basic>closed</basic></status>
+  </tuple>
+</presence>"""
+
+
+def display_pidf(body):
+    # The full parser the fast path has to agree with, on an application that was never started
+    application = main.SubscriptionApplication.__new__(main.SubscriptionApplication)
+    return application._display_pidf(main.PIDF.parse(body))
+
+
+class ExtractStatusTest(unittest.TestCase):
+
+    def assertMatches(self, body, status):
+        self.assertEqual(pidfparser.extract_status(body), status)
+        self.assertEqual(display_pidf(body), status)
+
+    def test_pidf_notes(self):
+        self.assertMatches(PIDF_NOTES, 'Available')
+
+    def test_person_notes(self):
+        self.assertMatches(PERSON_NOTES, 'Talk:1002')
+
+    def test_person_without_notes(self):
+        self.assertMatches(PERSON_WITHOUT_NOTES, 'Ring 1002')
+
+    def test_no_notes(self):
+        self.assertMatches(NO_NOTES, None)
+
+    def test_not_pidf(self):
+        self.assertRaises(pidfparser.FastPathError, pidfparser.extract_status, '<list xmlns="urn:ietf:params:xml:ns:rlmi"/>')
+
+
+class PIDFParseCacheTest(unittest.TestCase):
+
+    def test_falls_back_and_remembers(self):
+        fallbacks = []
+
+        def fallback(body):
+            fallbacks.append(body)
+            return 'fallback'
+        cache = pidfparser.PIDFParseCache(1, fallback)
+        self.assertEqual(cache.status('<list/>'), 'fallback')
+        self.assertEqual(cache.status('<list/>'), 'fallback')
+        self.assertEqual(len(fallbacks), 1)
+        self.assertEqual(cache.status(PIDF_NOTES), 'Available')
+        self.assertEqual(list(cache.entries.values()), ['Available'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import presencecache
+
+
+class PresenceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = presencecache.PresenceCache()
+
+    def test_update_normalizes_status(self):
+        entry = self.cache.update('1001', '  Talk   1002 ')
+        self.assertEqual(entry.status, 'talk 1002')
+        self.assertEqual(self.cache.get('1001'), 'talk 1002')
+
+    def test_unchanged_status_is_not_a_change(self):
+        first = self.cache.update('1001', 'Available')
+        self.assertIsNone(self.cache.update('1001', 'available '))
+        self.assertEqual(self.cache.version, first.version)
+
+    def test_missing_status_is_ignored(self):
+        self.assertIsNone(self.cache.update('1001', None))
+        self.assertIsNone(self.cache.get('1001'))
+
+    def test_changes_since(self):
+        self.cache.update('1001', 'available')
+        version = self.cache.version
+        self.cache.update('1002', 'ring 1003')
+        self.cache.update('1001', 'talk 1003')
+        self.cache.remove('1002')
+        changes = [(extension, entry.status if entry is not None else None) for changeversion, extension, entry in self.cache.changes_since(version)]
+        self.assertEqual(changes, [('1001', 'talk 1003'), ('1002', None)])
+
+    def test_changes_since_current_version(self):
+        self.cache.update('1001', 'available')
+        self.assertEqual(self.cache.changes_since(self.cache.version), [])
+
+    def test_update_after_remove(self):
+        self.cache.update('1001', 'available')
+        self.cache.remove('1001')
+        self.cache.update('1001', 'available')
+        changes = self.cache.changes_since(0)
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0][2].status, 'available')
+
+
+if __name__ == '__main__':
+    unittest.main()
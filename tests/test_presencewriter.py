@@ -0,0 +1,95 @@
+import os
+import sys
+import unittest
+
+from threading import Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import dbmanager
+
+
+class Manager(object):
+
+    def __init__(self, flushinterval, flushthreshold):
+        self.flushinterval = flushinterval
+        self.flushthreshold = flushthreshold
+        self.eventlogsize = 100
+        self.subscriptionapp = None
+
+
+# Keeps the batches instead of writing them to Postgres
+class RecordingWriter(dbmanager.PresenceWriter):
+
+    def __init__(self, manager):
+        dbmanager.PresenceWriter.__init__(self, manager)
+        self.batches = []
+        self.written = Event()
+
+    def _write(self, batch, events=()):
+        self.batches.append(dict((extension, presence) for extension, (presence, received) in batch.items()))
+        self.written.set()
+        return True
+
+    def _close(self):
+        pass
+
+
+class PresenceWriterTest(unittest.TestCase):
+
+    def start(self, flushinterval, flushthreshold):
+        self.writer = RecordingWriter(Manager(flushinterval, flushthreshold))
+        self.writer.start()
+        return self.writer
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def test_single_update_under_threshold(self):
+        writer = self.start(0.05, 500)
+        writer.put('1001', 'available')
+        self.assertTrue(writer.written.wait(2))
+        self.assertEqual(writer.batches, [{'1001': 'available'}])
+
+    def test_update_after_idle(self):
+        writer = self.start(0.05, 500)
+        writer.put('1001', 'available')
+        self.assertTrue(writer.written.wait(2))
+        writer.written.clear()
+        writer.put('1002', 'ring 1001')
+        self.assertTrue(writer.written.wait(2))
+        self.assertEqual(writer.batches[-1], {'1002': 'ring 1001'})
+
+    def test_coalesces_within_interval(self):
+        writer = self.start(0.5, 500)
+        writer.put('1001', 'ring 1002')
+        writer.put('1001', 'talk 1002')
+        writer.put('1002', 'talk 1001')
+        self.assertTrue(writer.written.wait(2))
+        self.assertEqual(writer.batches, [{'1001': 'talk 1002', '1002': 'talk 1001'}])
+
+    def test_threshold_flushes_early(self):
+        writer = self.start(30, 2)
+        writer.put('1001', 'available')
+        writer.put('1002', 'available')
+        self.assertTrue(writer.written.wait(2))
+        self.assertEqual(writer.batches, [{'1001': 'available', '1002': 'available'}])
+
+    def test_forget(self):
+        writer = self.start(0.5, 500)
+        writer.put('1001', 'available')
+        writer.put('1002', 'available')
+        writer.forget('1002')
+        self.assertTrue(writer.written.wait(2))
+        self.assertEqual(writer.batches, [{'1001': 'available'}])
+        self.assertEqual(writer.latest, {'1001': 'available'})
+
+    def test_drop_keeps_newer_presence(self):
+        writer = self.start(30, 500)
+        writer.latest = {'1001': 'talk 1002', '1002': 'available'}
+        writer._drop({'1001': ('talk 1002', None), '1002': ('ring 1001', None)})
+        self.assertEqual(writer.latest, {'1002': 'available'})
+
+
+if __name__ == '__main__':
+    unittest.main()
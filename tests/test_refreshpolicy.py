@@ -0,0 +1,46 @@
+import os
+import sys
+import unittest
+
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import presencecache
+import refreshpolicy
+
+
+def entry(status, idle):
+    return presencecache.PresenceEntry(status, time() - idle, 1)
+
+
+class RefreshPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = refreshpolicy.RefreshPolicy(600, 3600, 900)
+
+    def test_no_status(self):
+        self.assertEqual(self.policy.interval(None), 600)
+
+    def test_busy(self):
+        self.assertEqual(self.policy.interval(entry('talk 1002', 100000)), 600)
+        self.assertEqual(self.policy.interval(entry('ring 1002', 100000)), 600)
+
+    def test_recently_changed(self):
+        self.assertEqual(self.policy.interval(entry('available', 60)), 600)
+
+    def test_idle_doubles(self):
+        self.assertEqual(self.policy.interval(entry('available', 1000)), 1200)
+        self.assertEqual(self.policy.interval(entry('available', 2000)), 2400)
+        self.assertEqual(self.policy.interval(entry('available', 100000)), 3600)
+
+    def test_unregistered(self):
+        self.assertEqual(self.policy.interval(entry('unregistered', 1000)), 3600)
+
+    def test_no_range(self):
+        policy = refreshpolicy.RefreshPolicy(600, 600, 900)
+        self.assertEqual(policy.interval(entry('available', 100000)), 600)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import resourcelist
+
+BOUNDARY = '50UBfW7LSCVLtggUPe5z'
+
+PIDF = """<?xml version="1.0" encoding="UTF-8"?>
+<presence xmlns="urn:ietf:params:xml:ns:pidf" entity="sip:%s@example.com">
+  <tuple id="t1">
+    <status><basic>open</basic></status>
+    <note>%s</note>
+  </tuple>
+</presence>"""
+
+RLMI = """<?xml version="1.0" encoding="UTF-8"?>
+<list xmlns="urn:ietf:params:xml:ns:rlmi" uri="sip:blf-list@example.com" version="1" fullState="true">
+  <resource uri="sip:1001@example.com">
+    <instance id="a1" state="active" cid="1001part@example.com"/>
+  </resource>
+  <resource uri="sip:1002@example.com">
+    <instance id="b1" state="active" cid="1002part@example.com"/>
+  </resource>
+  <resource uri="sip:1003@example.com">
+    <instance id="c1" state="pending"/>
+  </resource>
+</list>"""
+
+
+def part(contenttype, cid, body):
+    return '--%s\r\nContent-Transfer-Encoding: binary\r\nContent-ID: <%s>\r\nContent-Type: %s\r\n\r\n%s\r\n' % (BOUNDARY, cid, contenttype, body)
+
+
+BODY = (part(resourcelist.RLMI_CONTENT_TYPE, 'rlmi@example.com', RLMI) +
+        part(resourcelist.PIDF_CONTENT_TYPE, '1001part@example.com', PIDF % ('1001', 'Available')) +
+        part(resourcelist.PIDF_CONTENT_TYPE, '1002part@example.com', PIDF % ('1002', 'Talk 1001')) +
+        '--%s--\r\n' % BOUNDARY)
+
+PARAMETERS = {'type': '"application/rlmi+xml"', 'start': '"<rlmi@example.com>"', 'boundary': BOUNDARY}
+
+
+class ResourcePartsTest(unittest.TestCase):
+
+    def test_maps_parts_to_resources(self):
+        parts = dict(resourcelist.resource_parts(resourcelist.MULTIPART_CONTENT_TYPE, PARAMETERS, BODY))
+        self.assertEqual(sorted(parts), ['sip:1001@example.com', 'sip:1002@example.com'])
+        self.assertIn(b'<note>Talk 1001</note>', parts['sip:1002@example.com'])
+
+    def test_without_boundary(self):
+        self.assertEqual(resourcelist.resource_parts(resourcelist.MULTIPART_CONTENT_TYPE, {}, BODY), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import routecache
+
+Route = namedtuple('Route', ['address', 'port', 'transport'])
+
+FIRST = Route('10.0.0.1', 5060, 'udp')
+SECOND = Route('10.0.0.2', 5060, 'udp')
+
+
+class RouteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = routecache.RouteCache(300, minbackoff=10, maxbackoff=40)
+
+    def test_empty(self):
+        self.assertTrue(self.cache.expired)
+        self.assertIsNone(self.cache.current())
+
+    def test_current_is_first_route(self):
+        self.cache.update([FIRST, SECOND])
+        self.assertFalse(self.cache.expired)
+        self.assertEqual(self.cache.current(), FIRST)
+
+    def test_failed_route_is_skipped(self):
+        self.cache.update([FIRST, SECOND])
+        self.cache.failed(FIRST)
+        self.assertEqual(self.cache.current(), SECOND)
+        self.cache.succeeded(FIRST)
+        self.assertEqual(self.cache.current(), FIRST)
+
+    def test_all_failed_picks_soonest(self):
+        self.cache.update([FIRST, SECOND])
+        self.cache.failed(FIRST)
+        self.cache.failed(FIRST)
+        self.cache.failed(SECOND)
+        self.assertEqual(self.cache.current(), SECOND)
+
+    def test_backoff_doubles_up_to_maximum(self):
+        self.cache.update([FIRST])
+        self.assertEqual([self.cache.failed(FIRST) for attempt in range(4)], [10, 20, 40, 40])
+
+    def test_update_forgets_dropped_routes(self):
+        self.cache.update([FIRST, SECOND])
+        self.cache.failed(FIRST)
+        self.cache.failed(SECOND)
+        self.cache.update([FIRST])
+        self.assertEqual(list(self.cache.failures), [routecache.RouteCache.key(FIRST)])
+
+    def test_update_ttl(self):
+        self.cache.update([FIRST], ttl=0)
+        self.assertTrue(self.cache.expired)
+
+
+if __name__ == '__main__':
+    unittest.main()